@@ -5,6 +5,8 @@ alter table pasd_fndh_state owner to pasd;
 alter table pasd_smartbox_port_status owner to pasd;
 alter table pasd_fndh_port_status owner to pasd;
 alter table pasd_stations owner to pasd;
+alter view pasd_fndh_port_status_v owner to pasd;
+alter view pasd_smartbox_port_status_v owner to pasd;
 
 grant select on pasd_antenna_portmap to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
 grant select on pasd_fibre_portmap to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
@@ -13,3 +15,5 @@ grant select on pasd_fndh_state to mwaschedule, mwa_ro, mwa, tapuser, mwacode, P
 grant select on pasd_smartbox_port_status to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
 grant select on pasd_fndh_port_status to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
 grant select on pasd_stations to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
+grant select on pasd_fndh_port_status_v to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
+grant select on pasd_smartbox_port_status_v to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
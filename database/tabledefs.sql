@@ -238,6 +238,40 @@ CREATE TABLE pasd_fndh_port_status (
 CREATE INDEX pasd_fndh_port_status_smartbox_number on pasd_fndh_port_status (smartbox_number);
 
 
+/* Views on the two port status tables, with the human-readable status text that 'scmd.py' displays for each
+   port built by the database server, instead of client-side. The 'status_epoch' column is the status_timestamp
+   as a unix timestamp, so the client can work out the age of the data.
+
+   To add these views to an existing database, run upgrade_port_status_views.sql (keep the two in step).
+*/
+
+CREATE VIEW pasd_fndh_port_status_v AS
+    SELECT station_id, pdoc_number, smartbox_number,
+           extract(epoch from status_timestamp) AS status_epoch,
+           CASE WHEN smartbox_number > 0 THEN 'SB' || lpad(smartbox_number::text, 2, '0') ELSE '----' END AS sbstring,
+           concat_ws(' ',
+                     CASE power_state WHEN true THEN 'Power:ON' WHEN false THEN 'Power:OFF' ELSE 'Power:?' END,
+                     '(System:' || CASE system_online WHEN true THEN 'Online' WHEN false THEN 'Offline' ELSE '??line?' END || ')',
+                     '(DesireEnabled:' || CASE desire_enabled_online WHEN true THEN 'Online' WHEN false THEN '' ELSE '?' END ||
+                         ',' || CASE desire_enabled_offline WHEN true THEN 'Offline' WHEN false THEN '' ELSE '?' END || ')',
+                     CASE WHEN locally_forced_on THEN 'Forced:ON' WHEN locally_forced_off THEN 'Forced:OFF' ELSE 'NotForced' END,
+                     CASE power_sense WHEN true THEN 'PowerSense:ON' WHEN false THEN 'PowerSense:OFF' ELSE 'PowerSense:?' END
+                     ) AS status_string
+    FROM pasd_fndh_port_status;
+
+CREATE VIEW pasd_smartbox_port_status_v AS
+    SELECT station_id, smartbox_number, port_number, current_draw,
+           extract(epoch from status_timestamp) AS status_epoch,
+           concat_ws(' ',
+                     CASE power_state WHEN true THEN 'Power:ON' WHEN false THEN 'Power:OFF' ELSE 'Power:?' END,
+                     '(System:' || CASE system_online WHEN true THEN 'Online' WHEN false THEN 'Offline' ELSE '??line?' END || ')',
+                     '(DesireEnabled:' || CASE desire_enabled_online WHEN true THEN 'Online' WHEN false THEN '' ELSE '?' END ||
+                         ',' || CASE desire_enabled_offline WHEN true THEN 'Offline' WHEN false THEN '' ELSE '?' END || ')',
+                     CASE WHEN locally_forced_on THEN 'Forced:ON' WHEN locally_forced_off THEN 'Forced:OFF' ELSE 'NotForced' END
+                     ) AS status_string
+    FROM pasd_smartbox_port_status;
+
+
 /* Station management - reflects the state of the daemons managing each station, rather than the hardware that
    they control.
 */
@@ -0,0 +1,40 @@
+/* Upgrade script for station databases created before the port status views were added to tabledefs.sql.
+   'scmd.py fnpc status <ports>' and 'scmd.py sb <sbnum> status <ports>' read from these views, so run this once
+   against each existing station database, as a user that can create views and grant access, eg:
+
+   psql -d <dbname> -f database/upgrade_port_status_views.sql
+
+   It's safe to run more than once - existing views are replaced, and the owner and grants are set again.
+*/
+
+CREATE OR REPLACE VIEW pasd_fndh_port_status_v AS
+    SELECT station_id, pdoc_number, smartbox_number,
+           extract(epoch from status_timestamp) AS status_epoch,
+           CASE WHEN smartbox_number > 0 THEN 'SB' || lpad(smartbox_number::text, 2, '0') ELSE '----' END AS sbstring,
+           concat_ws(' ',
+                     CASE power_state WHEN true THEN 'Power:ON' WHEN false THEN 'Power:OFF' ELSE 'Power:?' END,
+                     '(System:' || CASE system_online WHEN true THEN 'Online' WHEN false THEN 'Offline' ELSE '??line?' END || ')',
+                     '(DesireEnabled:' || CASE desire_enabled_online WHEN true THEN 'Online' WHEN false THEN '' ELSE '?' END ||
+                         ',' || CASE desire_enabled_offline WHEN true THEN 'Offline' WHEN false THEN '' ELSE '?' END || ')',
+                     CASE WHEN locally_forced_on THEN 'Forced:ON' WHEN locally_forced_off THEN 'Forced:OFF' ELSE 'NotForced' END,
+                     CASE power_sense WHEN true THEN 'PowerSense:ON' WHEN false THEN 'PowerSense:OFF' ELSE 'PowerSense:?' END
+                     ) AS status_string
+    FROM pasd_fndh_port_status;
+
+CREATE OR REPLACE VIEW pasd_smartbox_port_status_v AS
+    SELECT station_id, smartbox_number, port_number, current_draw,
+           extract(epoch from status_timestamp) AS status_epoch,
+           concat_ws(' ',
+                     CASE power_state WHEN true THEN 'Power:ON' WHEN false THEN 'Power:OFF' ELSE 'Power:?' END,
+                     '(System:' || CASE system_online WHEN true THEN 'Online' WHEN false THEN 'Offline' ELSE '??line?' END || ')',
+                     '(DesireEnabled:' || CASE desire_enabled_online WHEN true THEN 'Online' WHEN false THEN '' ELSE '?' END ||
+                         ',' || CASE desire_enabled_offline WHEN true THEN 'Offline' WHEN false THEN '' ELSE '?' END || ')',
+                     CASE WHEN locally_forced_on THEN 'Forced:ON' WHEN locally_forced_off THEN 'Forced:OFF' ELSE 'NotForced' END
+                     ) AS status_string
+    FROM pasd_smartbox_port_status;
+
+alter view pasd_fndh_port_status_v owner to pasd;
+alter view pasd_smartbox_port_status_v owner to pasd;
+
+grant select on pasd_fndh_port_status_v to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
+grant select on pasd_smartbox_port_status_v to mwaschedule, mwa_ro, mwa, tapuser, mwacode, PUBLIC;
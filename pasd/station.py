@@ -492,7 +492,7 @@ class Station(object):
         """
         start_time = time.time()
         end_time = start_time + maxtime
-        while (time.time() < end_time):  # Process packets until we run out of time
+        while (time.time() < end_time) and (not self.wants_exit):  # Process packets until we run out of time, or are told to die
             # Set up the registers for the physical->smartbox/port mapping:
             slave_registers = {n:None for n in range(1, 257)}
             for port in self.antennae.values():
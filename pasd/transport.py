@@ -145,6 +145,20 @@ class Connection(object):
                 for threadid, buffer in self.buffers.items():
                     self.buffers[threadid] = bytes([])
 
+    def close(self):
+        """
+        Close the socket or serial port connection (if any), so that the port is released immediately instead of
+        waiting for the OS to clean it up when the process exits.
+        """
+        with self.readlock:
+            with self.writelock:
+                if self.ser is not None:
+                    try:
+                        self.ser.close()
+                    except (socket.error, serial.serialutil.SerialException):
+                        pass
+                    self.ser = None
+
     def _read(self, until=None, nbytes=1000):
         """
         Accepts the number of bytes to read, or an end of packet sequence, and returns that many bytes of data.
@@ -563,22 +577,26 @@ class Connection(object):
 
         return set(), set()
 
-    def readReg(self, modbus_address, regnum, numreg=1):
+    def readReg(self, modbus_address, regnum, numreg=1, raw=False):
         """
         Given a register number and the number of registers to read, return the raw register contents
         of the desired register/s.
 
-        This function will always either return a list of register value tuples from a validated packet, or throw an exception.
+        This function will always either return a list of register value tuples (or a bytes() object, if raw=True)
+        from a validated packet, or throw an exception.
 
         If a validated packet is received, but that packet is a Modbus exception, then ValueError is raised, indicating
         a problem with the packet contents, as parsed by the remote device.
 
         If no reply is received after retrying, or only a corrupted reply was received, then IOError is raised,
-        indicating a communications problem with the remote device.
+        indicating a communications problem with the remote device. A reply that doesn't contain exactly numreg
+        registers counts as corrupted, and the read is retried.
 
         :param modbus_address: MODBUS station number, 0-255
         :param regnum: Register number to read
         :param numreg: Number of registers to read (default 1)
+        :param raw: If True, return the register contents as a single bytes() object (MSB first for each register),
+                    without building a tuple for every register.
         :return: A list of register values, each a tuple of (MSB, LSB), where MSB and LSB are integers, 0-255
         """
 
@@ -631,11 +649,14 @@ class Connection(object):
                 self._flush()
                 continue
 
-            if len(reply) > 4:
+            # Reply is address, function code, byte count, then two bytes per register - check that it all agrees
+            if (len(reply) == 3 + 2 * numreg) and (reply[2] == 2 * numreg):
                 blist = reply[3:]
-                return [(blist[i], blist[i+1]) for i in range(0, len(blist), 2)]
+                if raw:
+                    return bytes(blist)
+                return list(zip(blist[0::2], blist[1::2]))
             else:
-                errs = "Short reply received. Resending.\n"
+                errs = "Short or malformed reply received (expected %d data bytes). Resending.\n" % (2 * numreg)
                 errs += "Packet: %s\n" % str(reply)
                 self.logger.error(errs)
                 time.sleep(1)
@@ -885,6 +906,17 @@ def NtoBytes(value, nbytes=2):
         return list(divmod(hw, 256)) + list(divmod(lw, 256))
 
 
+def pack16(msb, lsb):
+    """
+    Given the MSB and LSB of a 16-bit register value, return it as a single integer.
+
+    :param msb: Most significant byte, 0-255
+    :param lsb: Least significant byte, 0-255
+    :return: An integer, 0-65535
+    """
+    return (msb << 8) | lsb
+
+
 def bytestoN(valuelist):
     """
     Given a list or tuple of integers, or a list of tuples, in network order (MSB first), convert to an integer.
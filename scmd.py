@@ -9,12 +9,18 @@ The PaSD command tool can also be used to read current FNPC/smartbox/port status
 """
 
 from configparser import ConfigParser as conparser
+import contextlib
+import os
+import pickle
+import select
+import sqlite3
 import time
 
 import click
 
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
 
 
 # By default, psycopg2 converts fixed precision PostgreSQL columns to Decimal type in Python, and these can't be
@@ -30,9 +36,18 @@ MAX_SMARTBOX = 2
 
 MAX_AGE = 600   # If the last update was more than this many seconds ago, assume the station code isn't running.
 
+FRESH_CHANNEL = 'pasd_fresh'   # Channel that station_lmc.py NOTIFYs, with a unix timestamp, after every database update
+
 CPPATH = ['/usr/local/etc/pasd.conf', '/usr/local/etc/pasd-local.conf',
           './pasd.conf', './pasd-local.conf']
 
+# Parsed database connection parameters, cached along with the modification times of the CPPATH files
+DBCONFIG_CACHE = os.path.expanduser('~/.cache/pasd/dbconfig.pkl')
+
+# Local SQLite copy of recent status query results, shared between scmd invocations that use '--cached'. Kept
+# up to date by a separate 'scmd shadowd' process that listens for FRESH_CHANNEL notifications.
+SHADOW_CACHE = os.path.expanduser('~/.cache/pasd/state.sqlite')
+
 FNPC_STRING = """\
 FNPC on station %(station_id)s - last update %(age)0.1f seconds ago:
     ModBUS register revision: %(mbrv)s
@@ -76,7 +91,10 @@ SMARTBox at address: %(modbus_address)s on PDoC port %(pdoc_number)s - last upda
 SBVERSTRING = """\
 SB number %(sbnum)d: CPU=%(cpuid)s, Chip=%(chipid)s, Uptime=%(uptime)s, Firmware=%(firmware_version)s"""
 
-DB = None   # Will be replaced by a psycopg2 database connection object on startup
+DB = None   # Will be replaced by a psycopg2 database connection object when the database is first needed
+
+LAST_FRESH = 0.0   # Local unix time when the most recent FRESH_CHANNEL notification from station_lmc.py was received
+USE_SHADOW = False   # Set to True by the '--cached' option, to use (and update) the rows in SHADOW_CACHE
 
 
 def init():
@@ -86,17 +104,191 @@ def init():
     :return: None
     """
     global DB
+    dbconfig = get_dbconfig()
+    DB = psycopg2.connect(**dbconfig)
+
+
+@contextlib.contextmanager
+def db_cursor():
+    """
+    Yield a cursor on the database connection, connecting first if this is the first time the database is needed.
+    The transaction is committed when the block exits, or rolled back if there's an exception.
+
+    Commands only connect when they need to, so a 'status --cached' command answered from the local status cache
+    never touches the network.
+
+    :return: A psycopg2 cursor object, for use in a 'with' statement
+    """
+    if DB is None:
+        init()
+    with DB:
+        with DB.cursor() as curs:
+            yield curs
+
+
+def get_dbconfig():
+    """
+    Return the database connection parameters for this station, from the configuration files in CPPATH.
+
+    The parsed parameters are cached in DBCONFIG_CACHE, along with the modification times of all the configuration
+    files, so the files only need to be parsed again if one of them has changed since the last call.
+
+    :return: A dictionary with 'user', 'password', 'host' and 'database' keys, to pass to psycopg2.connect()
+    """
+    mtimes = tuple((fname, os.stat(fname).st_mtime) for fname in CPPATH if os.path.exists(fname))
+    try:
+        with open(DBCONFIG_CACHE, 'rb') as f:
+            cache_mtimes, cache_station_id, dbconfig = pickle.load(f)
+        if (cache_mtimes == mtimes) and (cache_station_id == STATION_ID):
+            return dbconfig
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass   # No cache yet, or it's corrupt, so parse the configuration files
+
     CP = conparser(defaults={})
     CPfile = CP.read(CPPATH)
     if not CPfile:
         print("Configuration file not found in: %s" % (CPPATH,))
 
     config = CP['station_%03d' % STATION_ID]
-    dbuser = config['dbuser']
-    dbhost = config['dbhost']
-    dbpass = config['dbpass']
-    dbname = config['dbname']
-    DB = psycopg2.connect(user=dbuser, password=dbpass, host=dbhost, database=dbname)
+    dbconfig = {'user':config['dbuser'],
+                'password':config['dbpass'],
+                'host':config['dbhost'],
+                'database':config['dbname']}
+
+    try:   # The cache contains the database password, so make sure only this user can read it
+        os.makedirs(os.path.dirname(DBCONFIG_CACHE), exist_ok=True)
+        with os.fdopen(os.open(DBCONFIG_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            pickle.dump((mtimes, STATION_ID, dbconfig), f)
+    except OSError:
+        pass   # Not being able to write the cache isn't fatal, we'll just parse the files again next time
+
+    return dbconfig
+
+
+def check_fresh():
+    """
+    Collect any FRESH_CHANNEL notifications sent by station_lmc.py since the last call, and if there were any,
+    record the local time in the LAST_FRESH global.
+
+    The timestamp in the notification payload comes from the clock on the station_lmc.py host, so it isn't used -
+    all the times compared against LAST_FRESH come from the local clock.
+
+    :return: The local unix time when the most recent notification was received (or 0.0)
+    """
+    global LAST_FRESH
+    DB.poll()
+    if DB.notifies:
+        del DB.notifies[:]
+        LAST_FRESH = time.time()
+    return LAST_FRESH
+
+
+def cached_query(query, params):
+    """
+    Return all the rows from the given query. If the '--cached' option was given, and the local status cache has
+    up to date rows for the same query, return those instead of going back to the database.
+
+    :param query: SQL query string
+    :param params: Query parameters, either a tuple or a dict
+    :return: A list of row tuples
+    """
+    key = (query, repr(params))
+    if USE_SHADOW:
+        rows = shadow_get(key)
+        if rows is not None:
+            return rows
+
+    fetchtime = time.time()   # Before the query, so a notification that arrives while it runs marks the rows stale
+    with db_cursor() as curs:
+        curs.execute(query, params)
+        rows = curs.fetchall()
+    if USE_SHADOW:
+        shadow_put(key, (fetchtime, rows))
+    return rows
+
+
+def open_shadow():
+    """
+    Open the local SQLite status cache, creating it if necessary.
+
+    :return: An sqlite3 connection object
+    """
+    os.makedirs(os.path.dirname(SHADOW_CACHE), exist_ok=True)
+    sconn = sqlite3.connect(SHADOW_CACHE, timeout=5)
+    sconn.execute('CREATE TABLE IF NOT EXISTS fresh (id INTEGER PRIMARY KEY CHECK (id = 0), last_fresh REAL)')
+    sconn.execute('CREATE TABLE IF NOT EXISTS query_cache (query TEXT, params TEXT, fetchtime REAL, rows BLOB, PRIMARY KEY (query, params))')
+    return sconn
+
+
+def shadow_get(key):
+    """
+    Return the cached rows for the given query from the local SQLite status cache, if they were fetched after
+    'scmd shadowd' received the last FRESH_CHANNEL notification, and less than MAX_AGE/2 seconds ago. Both times
+    come from the local clock.
+
+    If 'scmd shadowd' hasn't recorded a notification in the last MAX_AGE seconds, it (or the station code) isn't
+    running, so we can't tell whether the cached rows are stale, and None is returned.
+
+    :param key: A tuple of (query, repr(params))
+    :return: A list of row tuples, or None if there are no valid cached rows
+    """
+    try:
+        sconn = open_shadow()
+        try:
+            row = sconn.execute('SELECT last_fresh FROM fresh WHERE id = 0').fetchone()
+            if (row is None) or ((time.time() - row[0]) > MAX_AGE):
+                return None
+            last_fresh = row[0]
+            row = sconn.execute('SELECT fetchtime, rows FROM query_cache WHERE query = ? AND params = ?', key).fetchone()
+        finally:
+            sconn.close()
+    except (OSError, sqlite3.Error):
+        return None
+
+    if (row is None) or (row[0] <= last_fresh) or ((time.time() - row[0]) > MAX_AGE / 2):
+        return None
+    return pickle.loads(row[1])
+
+
+def shadow_put(key, value):
+    """
+    Save the rows for the given query in the local SQLite status cache.
+
+    :param key: A tuple of (query, repr(params))
+    :param value: A tuple of (fetch time, rows)
+    :return: None
+    """
+    fetchtime, rows = value
+    try:
+        sconn = open_shadow()
+        try:
+            with sconn:   # Commit transaction when block exits
+                sconn.execute('INSERT OR REPLACE INTO query_cache (query, params, fetchtime, rows) VALUES (?, ?, ?, ?)',
+                              key + (fetchtime, pickle.dumps(rows)))
+        finally:
+            sconn.close()
+    except (OSError, sqlite3.Error):
+        pass   # Not being able to write the cache isn't fatal
+
+
+def shadow_clear():
+    """
+    Remove all of the cached query results from the local SQLite status cache. Called after a command has changed
+    the desired state of the station, so a following 'status --cached' command doesn't show the old state.
+
+    :return: None
+    """
+    if not os.path.exists(SHADOW_CACHE):
+        return
+    try:
+        sconn = open_shadow()
+        try:
+            with sconn:   # Commit transaction when block exits
+                sconn.execute('DELETE FROM query_cache')
+        finally:
+            sconn.close()
+    except (OSError, sqlite3.Error):
+        pass   # Not being able to clear the cache isn't fatal, shadowd will purge the rows on the next notification
 
 
 def parse_values(valuelist, all_list=None):
@@ -138,17 +330,144 @@ def parse_values(valuelist, all_list=None):
     return ovalues
 
 
+def parse_sbnum(sbnum):
+    """
+    Take a single smartbox number string from the command line, and return it as an integer if it's a valid
+    smartbox address (1 to MAX_SMARTBOX).
+
+    :param sbnum: String, eg '1'
+    :return: Smartbox address as an integer, or None if sbnum isn't a valid smartbox number
+    """
+    if sbnum.isdigit() and (1 <= int(sbnum) <= MAX_SMARTBOX):
+        return int(sbnum)
+    return None
+
+
 @click.group()
 def cli():
     pass
 
 
+def _fnpc_status(act, portlist):
+    """
+    Print the FNPC status, or the status of the given PDoC ports, if the station code is running.
+
+    :param act: Action string, in upper case
+    :param portlist: List of PDoC port numbers (1-28) to display, or an empty list to display the FNPC status
+    :return: None
+    """
+    query = """SELECT mbrv, pcbrv, cpuid, chipid, firmware_version, uptime, 
+                      psu48v1_voltage, psu48v2_voltage, psu48v_current, status, indicator_state, 
+                      readtime, service_led, psu48v1_temp, psu48v2_temp, panel_temp, fncb_temp,
+                      fncb_humidity
+               FROM pasd_fndh_state
+               WHERE station_id = %s"""
+    rows = cached_query(query, (STATION_ID,))
+    if rows:
+        (mbrv, pcbrv, cpuid, chipid, firmware_version, uptime,
+         psu48v1_voltage, psu48v2_voltage, psu48v_current, status, indicator_state,
+         readtime, service_led, psu48v1_temp, psu48v2_temp, panel_temp, fncb_temp,
+         fncb_humidity) = rows[0]
+        age = time.time() - readtime
+
+    if not portlist:
+        paramdict = {'station_id':STATION_ID,
+                     'uptime':uptime,
+                     'age':age,
+                     'mbrv':mbrv,
+                     'pcbrv':pcbrv,
+                     'cpuid':cpuid,
+                     'chipid':chipid,
+                     'firmware_version':firmware_version,
+                     'psu48v1_voltage':psu48v1_voltage,
+                     'psu48v2_voltage':psu48v2_voltage,
+                     'psu48v_current':psu48v_current,
+                     'status':status,
+                     'indicator_state':indicator_state,
+                     'readtime':readtime,
+                     'service_led':service_led,
+                     'psu48v1_temp':psu48v1_temp,
+                     'psu48v2_temp':psu48v2_temp,
+                     'panel_temp':panel_temp,
+                     'fncb_temp':fncb_temp,
+                     'fncb_humidity':fncb_humidity}
+        if age < MAX_AGE:   # If recent enough:
+            print(FNPC_STRING % paramdict)
+        else:
+            print("Last update %0.1f seconds ago, station code not running." % age)
+    else:  # portlist suppled
+        if age < MAX_AGE:
+            query = """SELECT pdoc_number, status_epoch, sbstring, status_string
+                       FROM pasd_fndh_port_status_v
+                       WHERE (station_id = %(station_id)s) AND (pdoc_number = ANY(%(port_number)s))
+                       ORDER BY pdoc_number"""
+            rows = cached_query(query, {'station_id':STATION_ID, 'port_number':portlist})
+            now = time.time()
+            for pdoc_number, status_epoch, sbstring, status_string in rows:
+                print("P%02d(%s): Status(age %1.1f s): %s" % (pdoc_number, sbstring, now - status_epoch, status_string))
+        else:
+            print("Last update %0.1f seconds ago, station code not running." % age)
+
+
+def _fnpc_set(act, portlist):
+    """
+    Turn the given PDoC ports on or off.
+
+    :param act: Action string, in upper case - 'ON' or 'OFF'
+    :param portlist: List of PDoC port numbers (1-28)
+    :return: None, or -1 on error
+    """
+    if not portlist:
+        print('No matching ports, exiting.')
+        return -1
+
+    newstate = act == 'ON'
+    query = """UPDATE pasd_fndh_port_status 
+               SET desire_enabled_online = %s,
+                   desire_enabled_offline = %s
+               WHERE station_id = %s AND pdoc_number = ANY(%s)"""
+    with db_cursor() as curs:
+        curs.execute(query, (newstate, newstate, STATION_ID, portlist))
+    shadow_clear()   # Desired state has changed, so cached rows are out of date
+
+
+def _fnpc_led(act, portlist):
+    """
+    Turn the FNPC service LED on or off.
+
+    :param act: Action string, in upper case - 'LEDON' or 'LEDOFF'
+    :param portlist: Must be an empty list
+    :return: None, or -1 on error
+    """
+    if portlist:
+        print("Can't specify port list for service LED, exiting.")
+        return -1
+
+    newstate = act == 'LEDON'
+    query = """UPDATE pasd_fndh_state 
+               SET service_led = %s
+               WHERE station_id = %s"""
+    with db_cursor() as curs:
+        curs.execute(query, (newstate, STATION_ID))
+    shadow_clear()   # Desired state has changed, so cached rows are out of date
+
+
+# Dictionary with upper case action string as key, and the function to handle that action as value
+FNPC_ACTIONS = {'STATUS':_fnpc_status,
+                'ON':_fnpc_set,
+                'OFF':_fnpc_set,
+                'LEDON':_fnpc_led,
+                'LEDOFF':_fnpc_led}
+
+
 @cli.command('fnpc',
              short_help="Command or query the FNPC or a PDoC port",
              context_settings={"ignore_unknown_options": True})
 @click.argument('action', nargs=1)
 @click.argument('portnums', nargs=-1)
-def fnpc(portnums, action):
+@click.option('--cached', is_flag=True, default=False,
+              help="Use recent status results from the local cache, if 'scmd shadowd' is running")
+def fnpc(portnums, action, cached):
     """
     Turn PDoC ports on or off on the FNPC
 
@@ -162,120 +481,145 @@ def fnpc(portnums, action):
     $ scmd fnpc on all -3 -5      # turns on all ports EXCEPT 3 and 5
     $ scmd fnpc status            # displays the FNPC status
     $ scmd fnpc status 1 2 3      # displays the status of ports 1, 2 and 3
+    $ scmd fnpc status --cached   # displays the FNPC status, from the local cache if it's up to date
     """
+    global USE_SHADOW
+    USE_SHADOW = cached
+    act = action.upper()
+    handler = FNPC_ACTIONS.get(act)
+    if handler is None:
+        print('Action must be "on", "off", "ledon", "ledoff", or "status", not "%s"' % action)
+        return -1
+
     portlist = parse_values(valuelist=portnums, all_list=list(range(1, 29)))
 
-    with DB:
-        with DB.cursor() as curs:
-            if action.upper() == 'STATUS':
-                query = """SELECT mbrv, pcbrv, cpuid, chipid, firmware_version, uptime, 
-                                  psu48v1_voltage, psu48v2_voltage, psu48v_current, status, indicator_state, 
-                                  readtime, service_led, psu48v1_temp, psu48v2_temp, panel_temp, fncb_temp,
-                                  fncb_humidity
-                           FROM pasd_fndh_state
-                           WHERE station_id = %s"""
-                curs.execute(query, (STATION_ID,))
-                rows = curs.fetchall()
-                if rows:
-                    (mbrv, pcbrv, cpuid, chipid, firmware_version, uptime,
-                     psu48v1_voltage, psu48v2_voltage, psu48v_current, status, indicator_state,
-                     readtime, service_led, psu48v1_temp, psu48v2_temp, panel_temp, fncb_temp,
-                     fncb_humidity) = rows[0]
-                    age = time.time() - readtime
-
-                if not portlist:
-                    paramdict = {'station_id':STATION_ID,
-                                 'uptime':uptime,
-                                 'age':age,
-                                 'mbrv':mbrv,
-                                 'pcbrv':pcbrv,
-                                 'cpuid':cpuid,
-                                 'chipid':chipid,
-                                 'firmware_version':firmware_version,
-                                 'psu48v1_voltage':psu48v1_voltage,
-                                 'psu48v2_voltage':psu48v2_voltage,
-                                 'psu48v_current':psu48v_current,
-                                 'status':status,
-                                 'indicator_state':indicator_state,
-                                 'readtime':readtime,
-                                 'service_led':service_led,
-                                 'psu48v1_temp':psu48v1_temp,
-                                 'psu48v2_temp':psu48v2_temp,
-                                 'panel_temp':panel_temp,
-                                 'fncb_temp':fncb_temp,
-                                 'fncb_humidity':fncb_humidity}
-                    if age < MAX_AGE:   # If recent enough:
-                        print(FNPC_STRING % paramdict)
-                    else:
-                        print("Last update %0.1f seconds ago, station code not running." % age)
-                else:  # portlist suppled
-                    if age < MAX_AGE:
-                        query = """SELECT pdoc_number, extract(epoch from status_timestamp), smartbox_number, system_online, locally_forced_on, 
-                                          locally_forced_off, power_state, power_sense, desire_enabled_online, desire_enabled_offline
-                                   FROM pasd_fndh_port_status
-                                   WHERE (station_id = %(station_id)s) AND (pdoc_number = ANY(%(port_number)s))
-                                   ORDER BY pdoc_number"""
-                        curs.execute(query, {'station_id':STATION_ID, 'port_number':portlist})
-                        rows = curs.fetchall()
-                        for row in rows:
-                            (pdoc_number, status_timestamp, smartbox_number, system_online, locally_forced_on, locally_forced_off, power_state,
-                             power_sense, desire_enabled_online, desire_enabled_offline) = row
-
-                            if locally_forced_on:
-                                lfstring = 'Forced:ON'
-                            elif locally_forced_off:
-                                lfstring = 'Forced:OFF'
-                            else:
-                                lfstring = 'NotForced'
-
-                            if smartbox_number:
-                                sbstring = "SB%02d" % smartbox_number
-                            else:
-                                sbstring = "----"
-
-                            enstring = '(DesireEnabled:%s)' % ','.join([{False:'', True:'Online', None:'?'}[desire_enabled_online],
-                                                                        {False:'', True:'Offline', None:'?'}[desire_enabled_offline]])
-
-                            sysstring = '(System:%s)' % ({False:'Offline', True:'Online', None:'??line?'}[system_online])
-
-                            status_items = ['Status(age %1.1f s):' % (time.time() - status_timestamp),
-                                            {False:'Power:OFF', True:'Power:ON', None:'Power:?'}[power_state],
-                                            sysstring,
-                                            enstring,
-                                            lfstring,
-                                            {False:'PowerSense:OFF', True:'PowerSense:ON', None:'PowerSense:?'}[power_sense]
-                                            ]
-                            status_string = ' '.join(status_items)
-                            print("P%02d(%s): %s" % (pdoc_number, sbstring, status_string))
-                    else:
-                        print("Last update %0.1f seconds ago, station code not running." % age)
-
-            elif action.upper() in ['ON', 'OFF']:
-                if not portlist:
-                    print('No matching ports, exiting.')
-                    return -1
-
-                newstate = action.upper() == 'ON'
-                query = """UPDATE pasd_fndh_port_status 
-                           SET desire_enabled_online = %s,
-                               desire_enabled_offline = %s
-                           WHERE station_id = %s AND pdoc_number = ANY(%s)"""
-                curs.execute(query, (newstate, newstate, STATION_ID, portlist))
-
-            elif action.upper() in ['LEDON', 'LEDOFF']:
-                if portlist:
-                    print("Can't specify port list for service LED, exiting.")
-                    return -1
-
-                newstate = action.upper() == 'LEDON'
-                query = """UPDATE pasd_fndh_state 
-                           SET service_led = %s
-                           WHERE station_id = %s"""
-                curs.execute(query, (newstate, STATION_ID))
-
-            else:
-                print('Action must be "on", "off", "ledon", "ledoff", or "status", not "%s"' % action)
-                return -1
+    return handler(act, portlist)
+
+
+def _sb_status(act, portlist, sboxes):
+    """
+    Print the status of the given smartboxes, or the status of the given ports on those smartboxes, if the station
+    code is running.
+
+    :param act: Action string, in upper case
+    :param portlist: List of port numbers (1-12) to display, or an empty list to display the smartbox status
+    :param sboxes: List of smartbox addresses
+    :return: None
+    """
+    query = """SELECT smartbox_number, mbrv, pcbrv, cpuid, chipid, firmware_version, uptime, 
+                      incoming_voltage, psu_voltage, psu_temp, pcb_temp, ambient_temp, status, 
+                      indicator_state, readtime, pdoc_number, service_led
+               FROM pasd_smartbox_state
+               WHERE (station_id = %(station_id)s) AND (smartbox_number = ANY(%(modbus_address)s))
+               ORDER BY smartbox_number"""
+    rows = cached_query(query, {'station_id':STATION_ID, 'modbus_address':sboxes})
+    for row in rows:
+        (smartbox_number, mbrv, pcbrv, cpuid, chipid, firmware_version, uptime,
+         incoming_voltage, psu_voltage, psu_temp, pcb_temp, ambient_temp, status,
+         indicator_state, readtime, pdoc_number, service_led) = row
+        try:
+            age = time.time() - readtime
+        except TypeError:
+            age = 9e99
+
+    if not portlist:
+        paramdict = {'station_id':STATION_ID,
+                     'modbus_address':smartbox_number,
+                     'uptime':uptime,
+                     'age':age,
+                     'mbrv':mbrv,
+                     'pcbrv':pcbrv,
+                     'cpuid':cpuid,
+                     'chipid':chipid,
+                     'firmware_version':firmware_version,
+                     'incoming_voltage':incoming_voltage,
+                     'psu_voltage':psu_voltage,
+                     'psu_temp':psu_temp,
+                     'pcb_temp':pcb_temp,
+                     'ambient_temp':ambient_temp,
+                     'status':status,
+                     'indicator_state':indicator_state,
+                     'readtime':readtime,
+                     'pdoc_number':pdoc_number,
+                     'service_led':service_led}
+        if age < MAX_AGE:
+            print(SMARTBOX_STRING % paramdict)
+        else:
+            print("Last update %0.1f seconds ago, station code not running." % age)
+    else:  # portlist suppled
+        if age < MAX_AGE:
+            query = """SELECT smartbox_number, port_number, status_epoch, status_string, current_draw
+                       FROM pasd_smartbox_port_status_v
+                       WHERE (station_id = %(station_id)s) AND 
+                             (smartbox_number = ANY(%(modbus_address)s)) AND 
+                             (port_number = ANY(%(port_number)s))
+                       ORDER BY smartbox_number, port_number"""
+            rows = cached_query(query, {'station_id':STATION_ID, 'modbus_address':sboxes, 'port_number':portlist})
+            now = time.time()
+            for smartbox_number, port_number, status_epoch, status_string, current_draw in rows:
+                print("SB%02d, P%02d: Status(age %1.1f s): %s Current:%5.1f" % (smartbox_number,
+                                                                                port_number,
+                                                                                now - status_epoch,
+                                                                                status_string,
+                                                                                current_draw))
+        else:
+            print("Last update %0.1f seconds ago, station code not running." % age)
+
+
+def _sb_set(act, portlist, sboxes):
+    """
+    Turn the given ports on the given smartboxes on or off.
+
+    :param act: Action string, in upper case - 'ON' or 'OFF'
+    :param portlist: List of port numbers (1-12)
+    :param sboxes: List of smartbox addresses
+    :return: None, or -1 on error
+    """
+    if not portlist:
+        print('No matching ports, exiting.')
+        return -1
+
+    newstate = act == 'ON'
+    query = """UPDATE pasd_smartbox_port_status 
+               SET desire_enabled_online = %s,
+                   desire_enabled_offline = %s
+               WHERE station_id = %s AND 
+                     smartbox_number = ANY(%s) AND
+                     port_number = ANY(%s)"""
+    with db_cursor() as curs:
+        curs.execute(query, (newstate, newstate, STATION_ID, sboxes, portlist))
+    shadow_clear()   # Desired state has changed, so cached rows are out of date
+
+
+def _sb_led(act, portlist, sboxes):
+    """
+    Turn the service LED on the given smartboxes on or off.
+
+    :param act: Action string, in upper case - 'LEDON' or 'LEDOFF'
+    :param portlist: Must be an empty list
+    :param sboxes: List of smartbox addresses
+    :return: None, or -1 on error
+    """
+    if portlist:
+        print("Can't specify port list for service LED, exiting.")
+        return -1
+
+    newstate = act == 'LEDON'
+    query = """UPDATE pasd_smartbox_state 
+               SET service_led = %s
+               WHERE station_id = %s  AND 
+                     smartbox_number = ANY(%s)"""
+    with db_cursor() as curs:
+        curs.execute(query, (newstate, STATION_ID, sboxes))
+    shadow_clear()   # Desired state has changed, so cached rows are out of date
+
+
+# Dictionary with upper case action string as key, and the function to handle that action as value
+SB_ACTIONS = {'STATUS':_sb_status,
+              'ON':_sb_set,
+              'OFF':_sb_set,
+              'LEDON':_sb_led,
+              'LEDOFF':_sb_led}
 
 
 @cli.command('sb',
@@ -284,7 +628,9 @@ def fnpc(portnums, action):
 @click.argument('sbnum', nargs=1)
 @click.argument('action', nargs=1)
 @click.argument('portnums', nargs=-1)
-def sb(portnums, action, sbnum):
+@click.option('--cached', is_flag=True, default=False,
+              help="Use recent status results from the local cache, if 'scmd shadowd' is running")
+def sb(portnums, action, sbnum, cached):
     """
     Turn FEM ports on or off on the given smartbox
 
@@ -300,129 +646,114 @@ def sb(portnums, action, sbnum):
     $ scmd sb 2 on all -3 -5     # turns on all ports EXCEPT 3 and 5
     $ scmd sb 1 status           # displays the status smartbox 1
     $ scmd sb 2 status 1 2 3     # displays the status of ports 1, 2 and 3 on smartbox 1
+    $ scmd sb 1 status --cached  # displays the status smartbox 1, from the local cache if it's up to date
     """
-    portlist = parse_values(valuelist=portnums, all_list=list(range(1, 13)))
-
-    if (not sbnum.isdigit()) and (sbnum.upper() != 'ALL'):
-        print("Second argument must be a single smartbox number (1-24), or 'all', not '%s'" % sbnum)
+    global USE_SHADOW
+    USE_SHADOW = cached
+    act = action.upper()
+    handler = SB_ACTIONS.get(act)
+    if handler is None:
+        print('Action must be "on", "off", "ledon", "ledoff", or "status", not "%s"' % action)
         return -1
 
+    portlist = parse_values(valuelist=portnums, all_list=list(range(1, 13)))
+
     if sbnum.upper() == 'ALL':
         sboxes = list(range(1, MAX_SMARTBOX + 1))
+    elif parse_sbnum(sbnum) is not None:
+        sboxes = [parse_sbnum(sbnum)]
     else:
-        sboxes = [int(sbnum)]
+        print("Second argument must be a single smartbox number (1-%d), or 'all', not '%s'" % (MAX_SMARTBOX, sbnum))
+        return -1
 
-    with DB:
-        with DB.cursor() as curs:
-            if action.upper() == 'STATUS':
-                query = """SELECT smartbox_number, mbrv, pcbrv, cpuid, chipid, firmware_version, uptime, 
-                                  incoming_voltage, psu_voltage, psu_temp, pcb_temp, ambient_temp, status, 
-                                  indicator_state, readtime, pdoc_number, service_led
-                           FROM pasd_smartbox_state
-                           WHERE (station_id = %(station_id)s) AND (smartbox_number = ANY(%(modbus_address)s))
-                           ORDER BY smartbox_number"""
-                curs.execute(query, {'station_id':STATION_ID, 'modbus_address':sboxes})
-                rows = curs.fetchall()
-                for row in rows:
-                    (smartbox_number, mbrv, pcbrv, cpuid, chipid, firmware_version, uptime,
-                     incoming_voltage, psu_voltage, psu_temp, pcb_temp, ambient_temp, status,
-                     indicator_state, readtime, pdoc_number, service_led) = row
-                    try:
-                        age = time.time() - readtime
-                    except TypeError:
-                        age = 9e99
-
-                if not portlist:
-                    paramdict = {'station_id':STATION_ID,
-                                 'modbus_address':smartbox_number,
-                                 'uptime':uptime,
-                                 'age':age,
-                                 'mbrv':mbrv,
-                                 'pcbrv':pcbrv,
-                                 'cpuid':cpuid,
-                                 'chipid':chipid,
-                                 'firmware_version':firmware_version,
-                                 'incoming_voltage':incoming_voltage,
-                                 'psu_voltage':psu_voltage,
-                                 'psu_temp':psu_temp,
-                                 'pcb_temp':pcb_temp,
-                                 'ambient_temp':ambient_temp,
-                                 'status':status,
-                                 'indicator_state':indicator_state,
-                                 'readtime':readtime,
-                                 'pdoc_number':pdoc_number,
-                                 'service_led':service_led}
-                    if age < MAX_AGE:
-                        print(SMARTBOX_STRING % paramdict)
-                    else:
-                        print("Last update %0.1f seconds ago, station code not running." % age)
-                else:  # portlist suppled
-                    if age < MAX_AGE:
-                        query = """SELECT smartbox_number, port_number, extract(epoch from status_timestamp), system_online, 
-                                          current_draw, locally_forced_on, locally_forced_off, breaker_tripped, power_state,
-                                          desire_enabled_online, desire_enabled_offline
-                                   FROM pasd_smartbox_port_status
-                                   WHERE (station_id = %(station_id)s) AND 
-                                         (smartbox_number = ANY(%(modbus_address)s)) AND 
-                                         (port_number = ANY(%(port_number)s))
-                                   ORDER BY smartbox_number, port_number"""
-                        curs.execute(query, {'station_id':STATION_ID, 'modbus_address':sboxes, 'port_number':portlist})
-                        rows = curs.fetchall()
-                        for row in rows:
-                            (smartbox_number, port_number, status_timestamp, system_online,
-                             current_draw, locally_forced_on, locally_forced_off, breaker_tripped, power_state,
-                             desire_enabled_online, desire_enabled_offline) = row
-                            if locally_forced_on:
-                                lfstring = 'Forced:ON'
-                            elif locally_forced_off:
-                                lfstring = 'Forced:OFF'
-                            else:
-                                lfstring = 'NotForced'
-                            enstring = '(DesireEnabled:%s)' % ','.join(
-                                    [{False:'', True:'Online', None:'?'}[desire_enabled_online],
-                                     {False:'', True:'Offline', None:'?'}[desire_enabled_offline]])
-                            sysstring = '(System:%s)' % ({False:'Offline', True:'Online', None:'??line?'}[system_online])
-                            status_items = ['Status(age %1.1f s):' % (time.time() - status_timestamp),
-                                            {False:'Power:OFF', True:'Power:ON', None:'Power:?'}[power_state],
-                                            sysstring,
-                                            enstring,
-                                            lfstring,
-                                            'Current:%5.1f' % current_draw
-                                            ]
-                            status_string = ' '.join(status_items)
-                            print("SB%02d, P%02d: %s" % (smartbox_number, port_number, status_string))
-                    else:
-                        print("Last update %0.1f seconds ago, station code not running." % age)
-
-            elif action.upper() in ['ON', 'OFF']:
-                if not portlist:
-                    print('No matching ports, exiting.')
-                    return -1
-
-                newstate = action.upper() == 'ON'
-                query = """UPDATE pasd_smartbox_port_status 
-                           SET desire_enabled_online = %s,
-                               desire_enabled_offline = %s
-                           WHERE station_id = %s AND 
-                                 smartbox_number = ANY(%s) AND
-                                 port_number = ANY(%s)"""
-                curs.execute(query, (newstate, newstate, STATION_ID, sboxes, portlist))
-
-            elif action.upper() in ['LEDON', 'LEDOFF']:
-                if portlist:
-                    print("Can't specify port list for service LED, exiting.")
-                    return -1
-
-                newstate = action.upper() == 'LEDON'
-                query = """UPDATE pasd_smartbox_state 
-                           SET service_led = %s
-                           WHERE station_id = %s  AND 
-                                 smartbox_number = ANY(%s)"""
-                curs.execute(query, (newstate, STATION_ID, sboxes))
-
-            else:
-                print('Action must be "on" or "off", not "%s"' % action)
-                return -1
+    return handler(act, portlist, sboxes)
+
+
+@cli.command('sbports',
+             short_help="Turn different FEM ports on or off on several smartboxes at once",
+             context_settings={"ignore_unknown_options": True})
+@click.argument('action', nargs=1)
+@click.argument('portspecs', nargs=-1)
+def sbports(portspecs, action):
+    """
+    Turn FEM ports on or off on several smartboxes, with a different set of ports on each, in a single database update.
+
+    ACTION is what to do - either 'on' or 'off'
+
+    PORTSPECS is one or more items, each of the form SBNUM:PORTNUMS, where SBNUM is a single smartbox address, and
+    PORTNUMS is a comma separated list of port numbers or the word 'all'. Port numbers are optionally preceded by a '-'
+    to exclude them.
+
+    \b
+    E.g.
+    $ scmd sbports on 1:1,2,3,4 2:5,6,7,8     # turns on ports 1-4 on smartbox 1, and ports 5-8 on smartbox 2
+    $ scmd sbports off 1:all,-12 2:all        # turns off all ports except 12 on smartbox 1, and all ports on smartbox 2
+    """
+    if action.upper() not in ['ON', 'OFF']:
+        print('Action must be "on" or "off", not "%s"' % action)
+        return -1
+    newstate = action.upper() == 'ON'
+
+    portmap = {}   # Dictionary with smartbox address as key, and a list of port numbers as value
+    for portspec in portspecs:
+        sbnum, sep, portnums = portspec.partition(':')
+        sbaddr = parse_sbnum(sbnum)
+        if sbaddr is None:
+            print("Each port spec must be SBNUM:PORTNUMS, with a single smartbox number (1-%d), not '%s'" % (MAX_SMARTBOX, portspec))
+            return -1
+        if (not sep) or (not portnums):
+            print("Each port spec must be SBNUM:PORTNUMS, with a list of port numbers after the ':', not '%s'" % portspec)
+            return -1
+        if sbaddr in portmap:
+            print("Smartbox %s is given in more than one port spec, combine them into one, not '%s'" % (sbnum, portspec))
+            return -1
+        portmap[sbaddr] = parse_values(valuelist=portnums.split(','), all_list=list(range(1, 13)))
+
+    # One row of (station_id, smartbox_number, port_number, state) for every port to change
+    valuelist = [(STATION_ID, sbnum, pnum, newstate) for sbnum, portlist in portmap.items() for pnum in portlist]
+    if not valuelist:
+        print('No matching ports, exiting.')
+        return -1
+
+    with db_cursor() as curs:
+        # Join against a VALUES list, so all of the ports are updated in one statement and one round trip
+        query = """UPDATE pasd_smartbox_port_status AS p
+                   SET desire_enabled_online = v.state,
+                       desire_enabled_offline = v.state
+                   FROM (VALUES %s) AS v(station_id, smartbox_number, port_number, state)
+                   WHERE p.station_id = v.station_id AND
+                         p.smartbox_number = v.smartbox_number AND
+                         p.port_number = v.port_number"""
+        psycopg2.extras.execute_values(curs, query, valuelist, page_size=len(valuelist))
+    shadow_clear()   # Desired state has changed, so cached rows are out of date
+
+
+@cli.command('shadowd',
+             short_help="Keep the local status cache used by '--cached' up to date")
+def shadowd():
+    """
+    Run forever, listening for notifications from station_lmc.py that new data has been written to the database,
+    and recording the time of each one in the local status cache. Any 'status --cached' command uses this to
+    tell whether its cached results are out of date.
+
+    \b
+    E.g.
+    $ scmd shadowd &
+    """
+    with db_cursor() as curs:
+        curs.execute('LISTEN %s' % FRESH_CHANNEL)
+
+    sconn = open_shadow()
+    try:
+        while True:
+            select.select([DB], [], [], MAX_AGE / 2)   # Wait for a notification, or timeout
+            last_fresh = check_fresh()
+            if last_fresh:
+                with sconn:   # Commit transaction when block exits
+                    sconn.execute('INSERT OR REPLACE INTO fresh (id, last_fresh) VALUES (0, ?)', (last_fresh,))
+                    sconn.execute('DELETE FROM query_cache WHERE fetchtime <= ?', (last_fresh,))
+    finally:
+        sconn.close()
 
 
 @cli.command('fwver',
@@ -436,42 +767,40 @@ def fwver():
     $ scmd fwver
     """
 
-    with DB:
-        with DB.cursor() as curs:
-            query = """SELECT cpuid, chipid, firmware_version, uptime, readtime
-                       FROM pasd_fndh_state
-                       WHERE (station_id = %(station_id)s)"""
-            curs.execute(query, {'station_id':STATION_ID})
-            (cpuid, chipid, firmware_version, uptime, readtime) = curs.fetchone()
+    with db_cursor() as curs:
+        query = """SELECT cpuid, chipid, firmware_version, uptime, readtime
+                   FROM pasd_fndh_state
+                   WHERE (station_id = %(station_id)s)"""
+        curs.execute(query, {'station_id':STATION_ID})
+        (cpuid, chipid, firmware_version, uptime, readtime) = curs.fetchone()
+        age = time.time() - readtime
+        paramdict = {'uptime':uptime,
+                     'cpuid':cpuid,
+                     'chipid':chipid,
+                     'firmware_version':firmware_version,}
+        if age < MAX_AGE:
+            print(FNPCVERSTRING % paramdict)
+
+        query = """SELECT smartbox_number, cpuid, chipid, firmware_version, uptime, readtime
+                   FROM pasd_smartbox_state
+                   WHERE (station_id = %(station_id)s)
+                   ORDER BY smartbox_number"""
+        curs.execute(query, {'station_id':STATION_ID})
+        rows = curs.fetchall()
+        for row in rows:
+            (smartbox_number, cpuid, chipid, firmware_version, uptime, readtime) = row
+
+            if not readtime:
+                continue
             age = time.time() - readtime
-            paramdict = {'uptime':uptime,
+            paramdict = {'sbnum':smartbox_number,
+                         'uptime':uptime,
                          'cpuid':cpuid,
                          'chipid':chipid,
                          'firmware_version':firmware_version,}
             if age < MAX_AGE:
-                print(FNPCVERSTRING % paramdict)
-
-            query = """SELECT smartbox_number, cpuid, chipid, firmware_version, uptime, readtime
-                       FROM pasd_smartbox_state
-                       WHERE (station_id = %(station_id)s)
-                       ORDER BY smartbox_number"""
-            curs.execute(query, {'station_id':STATION_ID})
-            rows = curs.fetchall()
-            for row in rows:
-                (smartbox_number, cpuid, chipid, firmware_version, uptime, readtime) = row
-
-                if not readtime:
-                    continue
-                age = time.time() - readtime
-                paramdict = {'sbnum':smartbox_number,
-                             'uptime':uptime,
-                             'cpuid':cpuid,
-                             'chipid':chipid,
-                             'firmware_version':firmware_version,}
-                if age < MAX_AGE:
-                    print(SBVERSTRING % paramdict)
+                print(SBVERSTRING % paramdict)
 
 
 if __name__ == '__main__':
-    init()
     cli()
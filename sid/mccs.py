@@ -5,9 +5,9 @@ Class to handle communication with the PaSD local MCCS, when it is acting as a M
 query the MCCS instead of the FNDH or a SMARTbox.
 """
 
+import array
 import logging
-
-logging.basicConfig()
+import struct
 
 from pasd import transport
 
@@ -25,10 +25,20 @@ PDOC_REGSTART = 1200  # One register for each PDoC (1-28), eg 1201-1228
 # where the last two registers are the 4-byte unix timestamp for when the message was logged.
 MESSAGE_LEN = 125
 
+# (first antenna number, number of registers) for each readReg() call needed to fetch all 256 physical antenna
+# registers, given the limit of 125 register values in a single packet.
+PHYSANT_CHUNKS = ((1, 100), (101, 100), (201, 56))
+
 
 class MCCS(transport.ModbusDevice):
     """
     MCCS class, an instance of which represents the PaSD local MCCS software
+
+    Note that self.pdocs and self.antennae are flat array.array('H') objects holding the raw register values, and
+    are indexed from zero (self.pdocs[0] is PDoC port 1, self.antennae[0] is physical antenna 1). They used to be
+    dicts keyed by port/antenna number starting at 1, with (SMARTbox_address, port_number) tuples as the antenna
+    values. Code that used self.antennae[antnum] should call self.get_antenna(antnum) instead, which takes the
+    1-based antenna number and returns a (SMARTbox_address, port_number) tuple (or None if it isn't mapped).
     """
     def __init__(self, conn=None, modbus_address=MCCS_ADDRESS, logger=None):
         """
@@ -39,11 +49,19 @@ class MCCS(transport.ModbusDevice):
 
         :param conn: An instance of transport.Connection() defining a connection to an FNDH
         :param modbus_address: The modbus station address of the MCCS, typically 63
+        :param logger: A logging.Logger object to use for all log messages, or None (in which case one will be created)
         """
+        if logger is None:   # Use a named logger, and leave the handler and level configuration to the application
+            logger = logging.getLogger('MCCS:%d' % modbus_address)
         transport.ModbusDevice.__init__(self, conn=conn, modbus_address=modbus_address, logger=logger)
-        self.pdocs = {}   # Dictionary with PDoC port number (1-28) as key, and SMARTbox address (or 0) as value
-        self.antennae = {}  # Dictionary with physical antenna number (1-256) as key, and a tuple of
-                            # (SMARTbox_address, port_number) as value
+        # Raw register contents are stored in flat arrays of unsigned 16-bit integers, indexed by number - 1
+        self.pdocs = array.array('H', [0] * 28)   # Index is PDoC port number (1-28) - 1, value is SMARTbox address (or 0)
+        self.antennae = array.array('H', [0] * 256)  # Index is physical antenna number (1-256) - 1, value is
+                                                     # SMARTbox_address * 256 + port_number (or 0 if unmapped)
+        self.antenna_index = {}   # Reverse of self.antennae - key is SMARTbox_address * 256 + port_number,
+                                  # value is physical antenna number (1-256). Unmapped antennae aren't included.
+        self.log_cursor = None   # (antenna, chipid registers, lognum) last written to the MCCS, if no message has been
+                                 # read since (reading a message advances the log number on the MCCS), or None
 
     def read_antennae(self):
         """
@@ -55,31 +73,85 @@ class MCCS(transport.ModbusDevice):
 
         :return: True if there were no errors, None on error.
         """
-        # Get a list of 28 tuples, where each tuple is a two-byte register value, eg (0,255)
+        # Get the raw contents of the 28 PDoC registers, two bytes (MSB first) per register
         try:
-            valuelist = self.conn.readReg(modbus_address=self.modbus_address, regnum=PDOC_REGSTART + 1, numreg=28)
-            if valuelist is None:
-                self.logger.error('Error reading register %d..%d from modbus address %d' % (PDOC_REGSTART + 1,
-                                                                                            PDOC_REGSTART + 1 + 28,
-                                                                                            self.modbus_address))
+            valuelist = self.conn.readReg(modbus_address=self.modbus_address, regnum=PDOC_REGSTART + 1, numreg=28, raw=True)
         except Exception:
             self.logger.exception('Exception in readReg in poll_data for pdoc mapping from MCCS')
             return None
 
-        self.pdocs = {pdoc_num:(valuelist[pdoc_num - 1][0] * 256 + valuelist[pdoc_num - 1][0]) for pdoc_num in range(1, 29)}
+        if valuelist is None:
+            self.logger.error('Error reading register %d..%d from modbus address %d' % (PDOC_REGSTART + 1,
+                                                                                        PDOC_REGSTART + 28,
+                                                                                        self.modbus_address))
+            return None
+
+        # Unpack the raw register bytes as big-endian 16-bit values in one call
+        self.pdocs = array.array('H', struct.unpack('>28H', valuelist))
 
-        # Get a list of 256 tuples, where each tuple is a two-byte register value, eg (0,255)
+        antennae = array.array('H', [0] * 256)
         try:   # Limit is 125 register values in a single packet, so split this into three readReg() calls
-            valuelist = self.conn.readReg(modbus_address=self.modbus_address, regnum=PHYSANT_REGSTART + 1, numreg=100)
-            valuelist += self.conn.readReg(modbus_address=self.modbus_address, regnum=PHYSANT_REGSTART + 101, numreg=100)
-            valuelist += self.conn.readReg(modbus_address=self.modbus_address, regnum=PHYSANT_REGSTART + 201, numreg=56)
+            for start, numreg, chunk in self._read_chunks(PHYSANT_CHUNKS):
+                if chunk is None:
+                    self.logger.error('Error reading register %d..%d from modbus address %d' % (PHYSANT_REGSTART + start,
+                                                                                                PHYSANT_REGSTART + start + numreg - 1,
+                                                                                                self.modbus_address))
+                    return None
+                # Decode each chunk as it arrives, before the next one is requested
+                antennae[start - 1:start - 1 + numreg] = array.array('H', struct.unpack('>%dH' % numreg, chunk))
         except Exception:
             self.logger.exception('Exception in readReg in poll_data for physical antenna mapping from MCCS')
             return None
 
-        self.antennae = {ant_num:valuelist[ant_num - 1] for ant_num in range(1, 257)}
+        self.antennae = antennae
+        self.antenna_index = {regvalue:antnum for antnum, regvalue in enumerate(self.antennae, 1) if regvalue}
         return True
 
+    def _read_chunks(self, chunks):
+        """
+        Generator that reads a block of physical antenna registers, one readReg() call per chunk, yielding each chunk
+        as soon as it has been received so that the caller can process it before the next one is requested.
+
+        :param chunks: A sequence of (first antenna number, number of registers) tuples, eg PHYSANT_CHUNKS
+        :return: Yields (first antenna number, number of registers, raw register bytes, or None on error)
+        """
+        for start, numreg in chunks:
+            yield start, numreg, self.conn.readReg(modbus_address=self.modbus_address,
+                                                   regnum=PHYSANT_REGSTART + start,
+                                                   numreg=numreg,
+                                                   raw=True)
+
+    def write_antennae(self):
+        """
+        Write the entire physical antenna to SMARTbox/port mapping in self.antennae back to the MCCS.
+
+        :return: True if there were no errors, None on error.
+        """
+        ok = True
+        try:   # Limit is 123 register values in a single write packet, so split this into three writeMultReg() calls
+            for start, numreg in PHYSANT_CHUNKS:
+                ok = ok and self.conn.writeMultReg(modbus_address=self.modbus_address,
+                                                   regnum=PHYSANT_REGSTART + start,
+                                                   valuelist=self.antennae[start - 1:start - 1 + numreg].tolist())
+        except Exception:
+            self.logger.exception('Exception in transport.writeMultReg():')
+            return None
+        return ok
+
+    def get_antenna(self, phys_num):
+        """
+        Return the SMARTbox address and port number that the given physical antenna is mapped to, from the
+        local copy of the antenna table (see read_antennae()).
+
+        :param phys_num: physical antenna number (1-256)
+        :return: A tuple of (smartbox_address, port_number), or None if that antenna isn't mapped.
+        """
+        regvalue = self.antennae[phys_num - 1]
+        if regvalue:
+            return divmod(regvalue, 256)
+        else:
+            return None
+
     def map_antenna(self, phys_num, smartbox_address, port_number):
         """
         Associate the given physical antenna number (1-256), and associate it with port number 'port_number' (1-12) on
@@ -88,7 +160,9 @@ class MCCS(transport.ModbusDevice):
         If any physical antenna was already mapped to the given SMARTbox address and port, then unmap that physical
         antenna first (so it's not mapped to any SMARTbox/port).
 
-        Then write the new mapping to the remote MCCS to update the remote database.
+        Then write the new mapping to the remote MCCS to update the remote database. Only the registers that have
+        changed are written - if they are next to each other, both go in one packet. Registers in between are never
+        written, because our local copy of them may be out of date if another client has changed the mapping.
 
         :param phys_num: physical antenna number (1-256)
         :param smartbox_address: SMARTbox modbus address (1-30)
@@ -97,16 +171,38 @@ class MCCS(transport.ModbusDevice):
         """
         unmapped_regnum = None
         mapped_regnum = None
-        for antnum in range(1,257):
-            if self.antennae[antnum] == (smartbox_address, port_number):
-                if antnum != phys_num:   # Another smartbox/port is already mapped to this physical antenna, so unmap it.
-                    self.antennae[antnum] = (0, 0)
-                    unmapped_regnum = antnum
-            elif antnum == phys_num:   # Add the new smartbox/port for this physical antenna number
-                self.antennae[antnum] = (smartbox_address, port_number)
-                mapped_regnum = antnum
+        regvalue = transport.pack16(smartbox_address, port_number)
+        antnum = self.antenna_index.get(regvalue)
+        if (antnum is not None) and (antnum != phys_num):   # This smartbox/port is already mapped to another physical antenna, so unmap it.
+            self.antennae[antnum - 1] = 0
+            del self.antenna_index[regvalue]
+            unmapped_regnum = antnum
+
+        oldvalue = self.antennae[phys_num - 1]
+        if oldvalue != regvalue:   # Add the new smartbox/port for this physical antenna number
+            if self.antenna_index.get(oldvalue) == phys_num:
+                del self.antenna_index[oldvalue]
+            self.antennae[phys_num - 1] = regvalue
+            self.antenna_index[regvalue] = phys_num
+            mapped_regnum = phys_num
 
         ok = True
+        if unmapped_regnum and mapped_regnum and (abs(unmapped_regnum - mapped_regnum) == 1):
+            # Both registers are next to each other, so write them in one packet
+            lo, hi = min(unmapped_regnum, mapped_regnum), max(unmapped_regnum, mapped_regnum)
+            try:
+                ok = self.conn.writeMultReg(modbus_address=self.modbus_address,
+                                            regnum=PHYSANT_REGSTART + lo,
+                                            valuelist=self.antennae[lo - 1:hi].tolist())
+            except:
+                self.logger.exception('Exception in transport.writeMultReg():')
+                return False
+
+            if ok:
+                self.logger.info('Disconnected antenna %d from port %d on SMARTbox %d.' % (unmapped_regnum, smartbox_address, port_number))
+                self.logger.info('Connected antenna %d to port %d on SMARTbox %d.' % (mapped_regnum, smartbox_address, port_number))
+            return ok
+
         if unmapped_regnum:
             try:
                 ok = self.conn.writeMultReg(modbus_address=self.modbus_address,
@@ -123,7 +219,7 @@ class MCCS(transport.ModbusDevice):
             try:
                 ok = self.conn.writeMultReg(modbus_address=self.modbus_address,
                                             regnum=mapped_regnum,
-                                            valuelist=[smartbox_address * 256 + port_number])
+                                            valuelist=[regvalue])
             except:
                 self.logger.exception('Exception in transport.writeMultReg():')
                 return False
@@ -149,7 +245,7 @@ class MCCS(transport.ModbusDevice):
         if desired_chipid is None:
             des_chip = [0] * 8
         else:
-            des_chip = [desired_chipid[i * 2] * 256 + desired_chipid[i * 2 + 1] for i in range(8)]
+            des_chip = list(struct.unpack('>8H', bytes(desired_chipid).ljust(16, b'\x00')))
 
         if desired_lognum is None:
             des_log = 0
@@ -157,6 +253,10 @@ class MCCS(transport.ModbusDevice):
             des_log = desired_lognum
 
         valuelist = [des_ant] + des_chip + [des_log]
+        if tuple(valuelist) == self.log_cursor:   # The MCCS already has this antenna/chipid/lognum, so skip the write
+            return self.get_next_log_message()
+
+        self.log_cursor = None   # If the write fails, we don't know what the MCCS has, so always write it next time
         try:
             ok = self.conn.writeMultReg(modbus_address=self.modbus_address, regnum=ANTNUM, valuelist=valuelist)
         except:
@@ -164,6 +264,7 @@ class MCCS(transport.ModbusDevice):
             return False
 
         if ok:
+            self.log_cursor = tuple(valuelist)
             return self.get_next_log_message()
         else:
             return None
@@ -175,26 +276,23 @@ class MCCS(transport.ModbusDevice):
 
         :return: None if there was an error, or A tuple of the log entry text, and a unix timestamp for when it was created
         """
+        self.log_cursor = None   # The MCCS moves on to the next log message after every read
         try:
-            messagelist = self.conn.readReg(modbus_address=self.modbus_address, regnum=MESSAGE, numreg=MESSAGE_LEN)
+            buf = self.conn.readReg(modbus_address=self.modbus_address, regnum=MESSAGE, numreg=MESSAGE_LEN, raw=True)
         except:
             self.logger.exception('Exception in transport.readReg():')
             return None
 
-        if messagelist is None:
+        if buf is None:
             return None
 
-        message_timestamp = transport.bytestoN(messagelist[-2:])
-
-        # Convert a list of MESSAGE_LEN-2 tuples of (msb, lsb) into a string, terminated at the first 0 byte.
-        charlist = []
-        for regvalue in messagelist[:-2]:
-            for b in regvalue:
-                if b > 0:
-                    charlist.append(b)
-                else:
-                    break
-        return bytes(charlist).decode('utf8'), message_timestamp
+        # The last four bytes of the raw register contents are the timestamp, and the rest is the message string,
+        # terminated at the first 0 byte.
+        message_timestamp = struct.unpack_from('>I', buf, len(buf) - 4)[0]
+        nul = buf.find(b'\x00', 0, len(buf) - 4)
+        if nul < 0:
+            nul = len(buf) - 4
+        return buf[:nul].decode('utf8'), message_timestamp
 
     def write_log_message(self, desired_antenna=None, desired_chipid=None, log_message=''):
         """
@@ -213,7 +311,7 @@ class MCCS(transport.ModbusDevice):
         if desired_chipid is None:
             des_chip = [0] * 8
         else:
-            des_chip = [desired_chipid[i * 2] * 256 + desired_chipid[i * 2 + 1] for i in range(8)]
+            des_chip = list(struct.unpack('>8H', bytes(desired_chipid).ljust(16, b'\x00')))
 
         # Truncate to fit in the packet, and add one or two nulls to make it an even number of bytes
         log_message = log_message[:(MESSAGE_LEN - 2) * 2 - 1]  # Truncate to fit in one packet
@@ -222,9 +320,12 @@ class MCCS(transport.ModbusDevice):
         else:
             log_message += chr(0)
 
-        valuelist = [des_ant] + des_chip + [0]
+        cursor = (des_ant, *des_chip, 0)
+        # Until both writes have succeeded, we don't know what the MCCS has, so the next get_log_message() must
+        # write the antenna/chipid/lognum registers again.
+        self.log_cursor = None
         try:
-            ok = self.conn.writeMultReg(modbus_address=self.modbus_address, regnum=ANTNUM, valuelist=valuelist)
+            ok = self.conn.writeMultReg(modbus_address=self.modbus_address, regnum=ANTNUM, valuelist=list(cursor))
         except:
             self.logger.exception('Exception in transport.writeMultReg():')
             return None
@@ -233,7 +334,7 @@ class MCCS(transport.ModbusDevice):
             valuelist = []
             for i in range(MESSAGE_LEN - 2):  # Iterate over registers in the log message block
                 if (i * 2) < len(log_message):
-                    valuelist.append(ord(log_message[i * 2]) * 256 + ord(log_message[i * 2 + 1]))
+                    valuelist.append(transport.pack16(ord(log_message[i * 2]), ord(log_message[i * 2 + 1])))
                 else:
                     valuelist.append(0)
             try:
@@ -242,6 +343,9 @@ class MCCS(transport.ModbusDevice):
                 self.logger.exception('Exception in transport.writeMultReg():')
                 return None
 
+            if ok:
+                self.log_cursor = cursor
+
         return ok
 
 
@@ -3,20 +3,46 @@
 import atexit
 import argparse
 import logging
+import logging.handlers
+import queue
 import sys
 import threading
 
+from pasd import transport
+from pasd import station
+from simulate import sim_fndh
+from simulate import sim_smartbox
+from simulate import sim_station
+
 LOGFILE = 'simulate.log'
+LOGBUFFER = 1024    # Number of log records to buffer before writing them to LOGFILE (ERROR and above are written at once)
 SIM_OBJECT = None   # Set to the smartbox, fndh or station instance when it's started
+SIM_THREAD = None   # Set to the threading.Thread() running the simulation when it's started
+CONN = None         # Set to the transport.Connection() instance when it's opened
+SHUTDOWN_TIMEOUT = 2.0   # Maximum time in seconds to wait for the simulation thread to exit on cleanup
+
+# Task name: (class, default modbus address, logger name prefix, thread name, startup message)
+SIM_TASKS = {'SMARTBOX': (sim_smartbox.SimSMARTbox, 1, 'SB', 'SB.thread',
+                          'Simulating SMARTbox as "s" on address %d.'),
+             'FNDH': (sim_fndh.SimFNDH, 101, 'FNDH', 'FNDH.thread',
+                      'Simulating FNDH as "s" on address %d.'),
+             'STATION': (sim_station.Sim_Station, 101, 'FNDH', 'FNDH.thread',
+                         'Simulating entire station as "s" - FNDH on address %d, SMARTboxes on addresses 1-24.'),
+             'MCCS': (station.Station, 199, 'MCCS', 'MCCS.thread',
+                      'Simulating the MCCS as "s" in slave mode, listening on address %d')}
 
 
 def cleanup():
     """Called automatically on exit - sets .wants_exit=True on the simulated object, so that the transport
-       and simulation threads shut down cleanly.
+       and simulation threads shut down cleanly, then closes the connection so the serial port is released.
     """
     print('Cleanup called.')
     if SIM_OBJECT is not None:
-        SIM_OBJECT.wants_ext = True
+        SIM_OBJECT.wants_exit = True
+    if SIM_THREAD is not None:
+        SIM_THREAD.join(timeout=SHUTDOWN_TIMEOUT)
+    if CONN is not None:
+        CONN.close()
 
 
 if __name__ == '__main__':
@@ -29,14 +55,18 @@ if __name__ == '__main__':
                         help='Serial port device name, eg /dev/ttyS0 or COM6')
     parser.add_argument('--multidrop', dest='multidrop', action='store_true', default=False,
                         help='Open connection in multidrop mode, so you can attach extra devices in "python -i ..." mode')
-    parser.add_argument('--address', dest='address', default=None,
+    parser.add_argument('--address', dest='address', type=int, default=None,
                         help='Modbus address (ignored when simulating a station)')
     parser.add_argument('--debug', dest='debug', default=False, action='store_true',
                         help='If given, drop to the DEBUG log level, otherwise use INFO')
     args = parser.parse_args()
     if (args.host is None) and (args.device is None):
         args.host = '134.7.50.185'
-    if args.task.upper() == 'STATION':
+    task = args.task.upper()
+    if task not in SIM_TASKS:
+        print('Task must be one of smartbox, fndh, station or mccs - not %s. Exiting.' % args.task)
+        sys.exit(-1)
+    if task == 'STATION':
         args.multidrop = True
 
     if args.debug:
@@ -44,56 +74,48 @@ if __name__ == '__main__':
     else:
         loglevel = logging.INFO
 
+    logformat = '%(levelname)s:%(name)s %(created)14.3f - %(threadName)s: %(message)s'
     fh = logging.FileHandler(filename=LOGFILE, mode='w')
     fh.setLevel(logging.DEBUG)   # All log messages go to the log file
+    fh.setFormatter(logging.Formatter(logformat))
+    mh = logging.handlers.MemoryHandler(capacity=LOGBUFFER, flushLevel=logging.ERROR, target=fh)   # Batch file writes
     sh = logging.StreamHandler()
     sh.setLevel(loglevel)        # Some or all log messages go to the console
-    logformat = '%(levelname)s:%(name)s %(created)14.3f - %(threadName)s: %(message)s'
+    sh.setFormatter(logging.Formatter(logformat))
+    # The simulation threads only put log records on a queue - formatting and I/O is done in the listener thread
+    logqueue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(logqueue, mh, sh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    qh = logging.handlers.QueueHandler(logqueue)
+    qh.setFormatter(logging.Formatter('%(message)s'))   # Only merge in the args, the listener's handlers do the rest
     # noinspection PyArgumentList
-    logging.basicConfig(handlers=[fh, sh],
+    logging.basicConfig(handlers=[qh],
                         level=logging.DEBUG,
-                        format=logformat)
-
-    from pasd import transport
-    from pasd import station
-    from simulate import sim_fndh
-    from simulate import sim_smartbox
-    from simulate import sim_station
+                        force=True)   # Replace the default handler added by library modules calling basicConfig() on import
 
     tlogger = logging.getLogger('T')
-    conn = transport.Connection(hostname=args.host, devicename=args.device, multidrop=args.multidrop, logger=tlogger)
+    conn = CONN = transport.Connection(hostname=args.host, devicename=args.device, multidrop=args.multidrop, logger=tlogger)
 
-    if args.task.upper() == 'SMARTBOX':
-        if args.address is None:
-            args.address = 1
-        slogger = logging.getLogger('SB:%d' % int(args.address))
-        s = SIM_OBJECT = sim_smartbox.SimSMARTbox(conn=conn, modbus_address=int(args.address), logger=slogger)
-        simthread = threading.Thread(target=s.sim_loop, daemon=False, name='SB.thread')
-        print('Simulating SMARTbox as "s" on address %d.' % int(args.address))
-    elif args.task.upper() == 'FNDH':
-        if args.address is None:
-            args.address = 101
-        flogger = logging.getLogger('FNDH:%d' % int(args.address))
-        f = SIM_OBJECT = sim_fndh.SimFNDH(conn=conn, modbus_address=int(args.address), logger=flogger)
-        simthread = threading.Thread(target=f.sim_loop, daemon=False, name='FNDH.thread')
-        print('Simulating FNDH as "f" on address %d.' % args.address)
-    elif args.task.upper() == 'STATION':
-        flogger = logging.getLogger('FNDH:%d' % 31)
-        s = SIM_OBJECT = sim_station.Sim_Station(conn=conn, modbus_address=101, logger=flogger)
-        simthread = threading.Thread(target=s.sim_loop, daemon=False, name='FNDH.thread')
-        print('Simulating entire station as "s" - FNDH on address 101, SMARTboxes on addresses 1-24.')
-    elif args.task.upper() == 'MCCS':
-        if args.address is None:
-            args.address = 199
-        mlogger = logging.getLogger('MCCS:%d' % int(args.address))
-        s = SIM_OBJECT = station.Station(conn=conn, station_id=int(args.address), logger=mlogger)
-        simthread = threading.Thread(target=s.listen, daemon=False, kwargs={'maxtime':999999}, name='MCCS.thread')
-        print('Simulating the MCCS as "s" in slave mode, listening on address %d' % int(args.address))
+    simclass, default_address, logname, threadname, message = SIM_TASKS[task]
+    if (args.address is None) or (task == 'STATION'):
+        args.address = default_address
+    slogger = logging.getLogger('%s:%d' % (logname, args.address))
+    if task == 'MCCS':
+        s = SIM_OBJECT = simclass(conn=conn, station_id=args.address, logger=slogger)
+        simthread = SIM_THREAD = threading.Thread(target=s.listen, daemon=True, kwargs={'maxtime':999999}, name=threadname)
     else:
-        print('Task must be one of smartbox, fndh, station or mccs - not %s. Exiting.' % args.task)
-        sys.exit(-1)
+        s = SIM_OBJECT = simclass(conn=conn, modbus_address=args.address, logger=slogger)
+        simthread = SIM_THREAD = threading.Thread(target=s.sim_loop, daemon=True, name=threadname)
+    print(message % args.address)
 
     atexit.register(cleanup)
 
     simthread.start()
     print('Started simulation thread')
+
+    if not sys.flags.interactive:   # The simulation threads are daemons, so wait here until Ctrl-C unless we're in 'python -i'
+        try:
+            simthread.join()
+        except KeyboardInterrupt:
+            pass
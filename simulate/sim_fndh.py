@@ -5,8 +5,13 @@ Simulates a FNDH, acting as a Modbus slave and responding to 0x03, 0x06 and 0x10
 to read and write registers. Used for testing PaSD code.
 """
 
+import bisect
+import collections
+import functools
 import logging
+import operator
 import random
+import struct
 import threading
 import time
 
@@ -16,6 +21,81 @@ logging.basicConfig()
 from pasd import fndh
 
 RETURN_BIAS = 0.025
+ONLINE_TIMEOUT = 300   # Go offline if we haven't heard from the MCCS for this many seconds
+SIM_TICK = 0.5   # Time in seconds between updates of the simulated sensor values in sim_loop()
+ERROR_DELAY_MIN = 0.1   # Initial delay in seconds before listening again after a comms error
+ERROR_DELAY_MAX = 5.0   # Maximum delay after repeated comms errors - the delay doubles after each one
+
+# Values of the two-bit 'desired state online' and 'desired state offline' fields in a port state bitmap that change
+# the desired state (00 means 'no change', 01 is invalid)
+DESIRE_FLAGS = {0b10:False, 0b11:True}
+
+# Two-bit 'desired state online' and 'desired state offline' fields written to a port state bitmap for each value of
+# desire_enabled_online or desire_enabled_offline (None gives 00, meaning 'no change')
+DESIRE_BITS = {False:0b10, True:0b11}
+
+# Values of the two-bit 'technician override' field in a port state bitmap, mapped to new values of
+# (locally_forced_on, locally_forced_off) - 00 means 'no change'
+OVERRIDE_FLAGS = {0b10:(False, True), 0b11:(True, False), 0b01:(False, False)}
+
+# POLL registers that never change while the simulator is running - these are only copied to the slave registers
+# dictionary at startup, and after any register write
+STATIC_POLL_REGS = frozenset(('SYS_MBRV', 'SYS_PCBREV', 'SYS_CPUID', 'SYS_CHIPID', 'SYS_FIRMVER', 'SYS_ADDRESS'))
+
+# POLL registers copied directly from a single instance attribute
+POLL_INT_ATTRS = {'SYS_MBRV':'mbrv',
+                  'SYS_PCBREV':'pcbrv',
+                  'SYS_FIRMVER':'firmware_version',
+                  'SYS_ADDRESS':'station_value',
+                  'SYS_STATUS':'statuscode'}
+
+# POLL registers holding a 32-bit instance attribute, MSW first
+POLL_LONG_ATTRS = {'SYS_CPUID':'cpuid',
+                   'SYS_UPTIME':'uptime'}
+
+# POLL registers converted from an instance attribute using the register's scaling function
+POLL_SCALED_ATTRS = {'SYS_48V1_V':'psu48v1_voltage',
+                     'SYS_48V2_V':'psu48v2_voltage',
+                     'SYS_48V_I':'psu48v_current',
+                     'SYS_48V1_TEMP':'psu48v1_temp',
+                     'SYS_48V2_TEMP':'psu48v2_temp',
+                     'SYS_PANELTEMP':'panel_temp',
+                     'SYS_FNCBTEMP':'fncb_temp',
+                     'SYS_HUMIDITY':'fncb_humidity'}
+
+# CONF (threshold) registers, and the instance attribute holding the sensor value to compare with those thresholds.
+# The SYS_SENSEnn_TH registers are compared with self.sensor_temps[nn].
+THRESHOLD_ATTRS = {'SYS_48V1_V_TH':'psu48v1_voltage',
+                   'SYS_48V2_V_TH':'psu48v2_voltage',
+                   'SYS_48V_I_TH':'psu48v_current',
+                   'SYS_48V1_TEMP_TH':'psu48v1_temp',
+                   'SYS_48V2_TEMP_TH':'psu48v2_temp',
+                   'SYS_PANELTEMP_TH':'panel_temp',
+                   'SYS_FNCBTEMP_TH':'fncb_temp',
+                   'SYS_HUMIDITY_TH':'fncb_humidity'}
+
+# Simulated sensor attributes, and the mean value that each one random-walks around in sim_loop()
+SENSOR_MEANS = (('psu48v1_voltage', 48.1),
+                ('psu48v2_voltage', 48.1),
+                ('psu48v_current', 13.4),
+                ('psu48v1_temp', 58.3),
+                ('psu48v2_temp', 5.1),
+                ('panel_temp', 55.1),
+                ('fncb_temp', 48.1),
+                ('fncb_humidity', 38.1))
+
+# Overall box status, and the indicator LED codes when offline and online, for each sensor state in decreasing order
+# of severity. If no sensor is in any of these states, the box status is BOX_OK.
+BOX_STATES = (('ALARM', (fndh.STATUS_ALARM, fndh.LED_RED, fndh.LED_REDSLOW)),
+              ('RECOVERY', (fndh.STATUS_RECOVERY, fndh.LED_YELLOWRED, fndh.LED_YELLOWREDSLOW)),
+              ('WARNING', (fndh.STATUS_WARNING, fndh.LED_YELLOW, fndh.LED_YELLOWSLOW)))
+BOX_OK = (fndh.STATUS_OK, fndh.LED_GREEN, fndh.LED_GREENSLOW)
+
+# Status codes where the FNDH turns on the PDoC ports (otherwise all ports are turned off)
+GOOD_CODES = frozenset((fndh.STATUS_OK, fndh.STATUS_WARNING))
+
+# Sensor state for each band of readings, from below the alarm-low threshold to above the alarm-high threshold
+THRESHOLD_BANDS = ('ALARM', 'WARNING', 'OK', 'WARNING', 'ALARM')
 
 STATUS_STRING = """\
 FNDH at address: %(modbus_address)s:
@@ -37,7 +117,7 @@ FNDH at address: %(modbus_address)s:
 """
 
 
-def random_walk(current_value, mean, scale=1.0, return_bias=RETURN_BIAS):
+def random_walk(current_value, mean, scale=1.0, return_bias=RETURN_BIAS, rand=random.random):
     """
     Take the current and desired mean values of a simulated sensor value, and generate the next value,
     to simulate a random walk around the mean value, with a bias towards returning to the mean.
@@ -48,12 +128,79 @@ def random_walk(current_value, mean, scale=1.0, return_bias=RETURN_BIAS):
     :param mean: Desired mean value
     :param scale: Scale factor for variations - a scale of one means random jumps of -1% to +1% every time step
     :param return_bias: Dimensionless factor - must be less than one. Lower values increase long-term variation around the mean
+    :param rand: Function returning a random float in [0.0, 1.0), eg the .random method of a random.Random() instance
     :return: Next value for the sensor reading
     """
     # with scale=1.0, value varies by +/- 1% of the mean value every iteration
     # with return_bias=1.0, value pulled back back by 100% of the offset from the mean at each iteration
     #                          random walk part, +/- scale percent                      return bias part
-    return current_value + (mean * scale * ((random.random() - 0.5) * 0.02)) + (return_bias * (mean - current_value))
+    return current_value + (mean * scale * ((rand() - 0.5) * 0.02)) + (return_bias * (mean - current_value))
+
+
+def threshold_state(curvalue, ah, wh, wl, al, curstate):
+    """
+    Given a sensor reading, the four thresholds for that sensor, and the current state of the sensor, return the new
+    state. Readings between the warning and alarm thresholds give 'WARNING', or 'RECOVERY' if the sensor was (or still
+    is) in 'ALARM' or 'RECOVERY'.
+
+    :param curvalue: Current sensor reading
+    :param ah: Alarm high threshold
+    :param wh: Warning high threshold
+    :param wl: Warning low threshold
+    :param al: Alarm low threshold
+    :param curstate: Current sensor state, eg 'OK'
+    :return: New sensor state - one of 'OK', 'WARNING', 'ALARM' or 'RECOVERY'
+    """
+    # Band 0 is below al, 1 is al-wl, 2 is wl-wh (inclusive), 3 is wh-ah, 4 is above ah
+    newstate = THRESHOLD_BANDS[bisect.bisect_right((al, wl), curvalue) + bisect.bisect_left((wh, ah), curvalue)]
+    if (newstate == 'WARNING') and (curstate in ('ALARM', 'RECOVERY')):
+        newstate = 'RECOVERY'
+    return newstate
+
+
+def port_bitmap(port):
+    """
+    Return the P<NN>_STATE register value for a simulated PDoC port, as returned by
+    port.status_to_integer(write_state=True, write_to=True, write_breaker=port.power_sense), but built with shifts
+    instead of a bit string, because it's called for all 28 ports every time around listen_loop().
+
+    :param port: An fndh.PdocStatus() instance
+    :return: 16 bit integer state bitmap
+    """
+    if port.locally_forced_off:
+        override = 0b10
+    elif port.locally_forced_on:
+        override = 0b11
+    else:
+        override = 0b01
+    return ((bool(port.system_level_enabled) << 15) |
+            (bool(port.system_online) << 14) |
+            (DESIRE_BITS.get(port.desire_enabled_online, 0) << 12) |
+            (DESIRE_BITS.get(port.desire_enabled_offline, 0) << 10) |
+            (override << 8) |
+            (bool(port.power_sense) << 7) |
+            (bool(port.power_state) << 6))
+
+
+def button_flag(name):
+    """
+    Return a property for one of the simulated button press flags (eg 'shortpress'). Setting the flag to True wakes
+    up sim_loop(), so the button press is handled straight away instead of on the next tick.
+
+    :param name: Name of the flag attribute
+    :return: A property object
+    """
+    attr = '_' + name
+
+    def getter(self):
+        return getattr(self, attr)
+
+    def setter(self, value):
+        setattr(self, attr, value)
+        if value:
+            self.button_event.set()
+
+    return property(getter, setter)
 
 
 class SimFNDH(fndh.FNDH):
@@ -61,6 +208,10 @@ class SimFNDH(fndh.FNDH):
     An instance of this class simulates a single FNDH, acting as a Modbus slave and responding to 0x03, 0x06 and
     0x10 Modbus commands to read and write registers.
     """
+    shortpress = button_flag('shortpress')
+    mediumpress = button_flag('mediumpress')
+    longpress = button_flag('longpress')
+
     def __init__(self, conn=None, modbus_address=None, logger=None):
         fndh.FNDH.__init__(self, conn=conn, modbus_address=modbus_address, logger=logger)
         # Inherited from the controller code in pasd/smartbox.py
@@ -89,19 +240,53 @@ class SimFNDH(fndh.FNDH):
         self.readtime = 0    # Unix timestamp for the last successful polled data from this FNDH
 
         # Only in the FNDH simulator class
-        self.start_time = 0   # Unix timestamp when this instance started processing
+        self.start_time = 0   # time.monotonic() value when this instance started processing, used for the uptime
+        self.heard_time = None   # time.monotonic() value when we last heard from the MCCS, or None if we never have
         self.wants_exit = False  # Set to True externally to kill self.mainloop if the box is pseudo-powered-off
         self.sensor_states = {regname:'UNINITIALISED' for regname in self.register_map['CONF']}  # OK, WARNING or RECOVERY
+        self.state_counts = collections.Counter(self.sensor_states.values())  # Number of sensors in each state - only
+                                                                              # change sensor_states via set_sensor_state()
         self.online = False   # Will be True if we've heard from the MCCS in the last 300 seconds.
         self.initialised = False   # True if the system has been initialised by the LMC
+        self.button_event = threading.Event()   # Set when any of the button press flags below is set to True
         self.shortpress = False   # Set to True to simulate a short button press (cleared when it's handled)
         self.mediumpress = False  # Set to True to simulate a medium button press (cleared when it's handled)
         self.longpress = False    # Set to True to simulate a long button press (never cleared)
+        self.rng = random.Random()   # Random number generator for this instance's sensor random walks
+        self.state_lock = threading.RLock()   # Held by sim_loop() and listen_loop() while they read or change the state
+        # Lists of functions, one per POLL register, that copy the simulated state into the slave_registers dictionary.
+        # The static_writers are only called when the slave_registers dictionary needs a full rebuild.
+        self.static_writers = []
+        self.poll_writers = []
+        for regname, regdef in self.register_map['POLL'].items():
+            writer = self._poll_writer(regname, *regdef)
+            if writer is None:
+                continue
+            if regname in STATIC_POLL_REGS:
+                self.static_writers.append(writer)
+            else:
+                self.poll_writers.append(writer)
+        # Register numbers for the R/W POLL registers handled in handle_register_writes()
+        self.pstate_base = self.register_map['POLL']['P01_STATE'][0]
+        self.pstate_regnums = frozenset(range(self.pstate_base, self.register_map['POLL']['P28_STATE'][0] + 1))
+        self.lights_regnum = self.register_map['POLL']['SYS_LIGHTS'][0]
+        self.status_regnum = self.register_map['POLL']['SYS_STATUS'][0]
+        # Dictionary with CONF register name as key, and a function returning the current sensor value as value
+        self.threshold_getters = {}
+        for regname in self.register_map['CONF']:
+            if regname in THRESHOLD_ATTRS:
+                self.threshold_getters[regname] = operator.attrgetter(THRESHOLD_ATTRS[regname])
+            elif regname.startswith('SYS_SENSE'):
+                self.threshold_getters[regname] = lambda sim, snum=int(regname[9:11]): sim.sensor_temps[snum]
+        # List of (regname, tuple of register numbers, scaling function) for each CONF register block, where the
+        # scaling function converts a threshold value to a raw register value for this PCB revision
+        self.conf_writers = [(regname,
+                              tuple(range(regnum, regnum + numreg)),
+                              functools.partial(scalefunc, reverse=True, pcb_version=self.pcbrv))
+                             for regname, (regnum, numreg, regdesc, scalefunc) in self.register_map['CONF'].items()]
 
     def __str__(self):
-        tmpdict = self.__dict__.copy()
-        tmpdict['status_age'] = time.time() - self.readtime
-        return ((STATUS_STRING % tmpdict) +
+        return ((STATUS_STRING % self.__dict__) +
                 "\nPorts:\n" + ("\n".join([str(self.ports[pnum]) for pnum in range(1, 29)])))
 
     def poll_data(self):
@@ -134,6 +319,55 @@ class SimFNDH(fndh.FNDH):
         """
         pass
 
+    def _poll_writer(self, regname, regnum, numreg, regdesc, scalefunc):
+        """
+        Return a function that takes the slave_registers dictionary, and copies the current value of the
+        given POLL register from the local instance attributes into it. This is only done once per register, when
+        the instance is created, so the listen_loop doesn't have to work out how to handle each register every time.
+
+        :param regname: Register name, eg 'SYS_48V1_V'
+        :param regnum: Register number
+        :param numreg: Number of registers
+        :param regdesc: Register description (unused)
+        :param scalefunc: Scaling function to convert the local value to a register value, or None
+        :return: A function taking a slave_registers dictionary, or None if the register isn't simulated
+        """
+        if regname in POLL_INT_ATTRS:
+            getter = operator.attrgetter(POLL_INT_ATTRS[regname])
+
+            def writer(slave_registers):
+                slave_registers[regnum] = getter(self)
+        elif regname in POLL_LONG_ATTRS:
+            getter = operator.attrgetter(POLL_LONG_ATTRS[regname])
+
+            def writer(slave_registers):
+                value = getter(self)
+                slave_registers[regnum], slave_registers[regnum + 1] = value >> 16, value & 0xFFFF   # MSB word first
+        elif regname in POLL_SCALED_ATTRS:
+            getter = operator.attrgetter(POLL_SCALED_ATTRS[regname])
+            scale = functools.partial(scalefunc, reverse=True, pcb_version=self.pcbrv)   # PCB revision is fixed
+
+            def writer(slave_registers):
+                slave_registers[regnum] = scale(getter(self))
+        elif regname == 'SYS_CHIPID':
+            # Two bytes of the chip ID per register, MSB first - the chip ID never changes, so only pack it once
+            regvals = struct.unpack('>%dH' % numreg, self.chipid)
+
+            def writer(slave_registers):
+                for i, value in enumerate(regvals):
+                    slave_registers[regnum + i] = value
+        elif regname == 'SYS_LIGHTS':
+            def writer(slave_registers):
+                slave_registers[regnum] = (256 if self.service_led else 0) | self.indicator_code   # Service LED in the MSB
+        elif (len(regname) >= 8) and ((regname[0] + regname[-6:]) == 'P_STATE'):
+            port = self.ports[int(regname[1:-6])]
+
+            def writer(slave_registers):
+                slave_registers[regnum] = port_bitmap(port)
+        else:
+            return None
+        return writer
+
     def loophook(self):
         """
         Stub, overwrite if you subclass this to handle more complex simulation. Called every time a packet has
@@ -163,65 +397,35 @@ class SimFNDH(fndh.FNDH):
 
         :return: None
         """
+        slave_registers = {}
+        rebuild = True   # The static POLL registers and the CONF registers only need copying after a register write
+        conf_source = None   # The thresholds dictionary that the CONF registers were last copied from
+        error_delay = ERROR_DELAY_MIN   # Time to wait after the next comms error
         while not self.wants_exit:  # Process packets until we are told to die
-            # Set up the registers for the physical->smartbox/port mapping:
-            slave_registers = {}
-            self.uptime = int(time.time() - self.start_time)  # Set the current uptime value
-
-            # Copy the local simulated instance data to the temporary registers dictionary - first the POLL registers
-            for regname in self.register_map['POLL']:
-                regnum, numreg, regdesc, scalefunc = self.register_map['POLL'][regname]
-                if regname == 'SYS_MBRV':
-                    slave_registers[regnum] = self.mbrv
-                elif regname == 'SYS_PCBREV':
-                    slave_registers[regnum] = self.pcbrv
-                elif regname == 'SYS_CPUID':
-                    slave_registers[regnum], slave_registers[regnum + 1] = divmod(self.cpuid, 65536)
-                elif regname == 'SYS_CHIPID':
-                    for i in range(numreg):
-                        slave_registers[regnum + i] = self.chipid[i // 2] * 256 + self.chipid[i // 2 + 1]
-                elif regname == 'SYS_FIRMVER':
-                    slave_registers[regnum] = self.firmware_version
-                elif regname == 'SYS_UPTIME':
-                    slave_registers[regnum], slave_registers[regnum + 1] = divmod(self.uptime, 65536)
-                elif regname == 'SYS_ADDRESS':
-                    slave_registers[regnum] = self.station_value
-                elif regname == 'SYS_48V1_V':
-                    slave_registers[regnum] = scalefunc(self.psu48v1_voltage, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_48V2_V':
-                    slave_registers[regnum] = scalefunc(self.psu48v2_voltage, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_48V_I':
-                    slave_registers[regnum] = scalefunc(self.psu48v_current, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_48V1_TEMP':
-                    slave_registers[regnum] = scalefunc(self.psu48v1_temp, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_48V2_TEMP':
-                    slave_registers[regnum] = scalefunc(self.psu48v2_temp, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_PANELTEMP':
-                    slave_registers[regnum] = scalefunc(self.panel_temp, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_FNCBTEMP':
-                    slave_registers[regnum] = scalefunc(self.fncb_temp, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_HUMIDITY':
-                    slave_registers[regnum] = scalefunc(self.fncb_humidity, reverse=True, pcb_version=self.pcbrv)
-                elif regname == 'SYS_STATUS':
-                    slave_registers[regnum] = self.statuscode
-                elif regname == 'SYS_LIGHTS':
-                    slave_registers[regnum] = int(self.service_led) * 256 + self.indicator_code
-                elif (len(regname) >= 8) and ((regname[0] + regname[-6:]) == 'P_STATE'):
-                    pnum = int(regname[1:-6])
-                    slave_registers[regnum] = self.ports[pnum].status_to_integer(write_state=True,
-                                                                                 write_to=True,
-                                                                                 write_breaker=self.ports[pnum].power_sense)
-
-            # Now copy the configuration data to the temporary register dictionary
-            for regname in self.register_map['CONF']:
-                regnum, numreg, regdesc, scalefunc = self.register_map['CONF'][regname]
-                if numreg == 1:
-                    slave_registers[regnum] = scalefunc(self.thresholds[regname], reverse=True)
-                else:
-                    (slave_registers[regnum],
-                     slave_registers[regnum + 1],
-                     slave_registers[regnum + 2],
-                     slave_registers[regnum + 3]) = (scalefunc(x, pcb_version=self.pcbrv, reverse=True) for x in self.thresholds[regname])
+            with self.state_lock:   # Don't let sim_loop() change the state while we copy it
+                self.uptime = int(time.monotonic() - self.start_time)  # Set the current uptime value
+
+                if rebuild or (self.thresholds is not conf_source):
+                    # Copy the fixed ID registers, and the configuration data, to the slave registers dictionary
+                    for writer in self.static_writers:
+                        writer(slave_registers)
+
+                    for regname, regnums, scale in self.conf_writers:
+                        if len(regnums) == 1:
+                            slave_registers[regnums[0]] = scale(self.thresholds[regname])
+                        else:
+                            ah, wh, wl, al = self.thresholds[regname]
+                            r0, r1, r2, r3 = regnums
+                            slave_registers[r0] = scale(ah)
+                            slave_registers[r1] = scale(wh)
+                            slave_registers[r2] = scale(wl)
+                            slave_registers[r3] = scale(al)
+                    conf_source = self.thresholds
+                    rebuild = False
+
+                # Copy the rest of the local simulated instance data (which changes all the time) to the registers dictionary
+                for writer in self.poll_writers:
+                    writer(slave_registers)
 
             # Wait up to one second for an incoming packet. On return, we get a set of registers numbers that were
             # read by that packet, and a set of register numbers that were written to by that packet. The
@@ -231,41 +435,50 @@ class SimFNDH(fndh.FNDH):
                                                                     slave_registers=slave_registers,
                                                                     maxtime=1,
                                                                     validation_function=None)
-            except:
+            except (IOError, ValueError) as err:   # Comms failure or garbled packet - includes serial/socket errors
+                self.logger.warning('Error in transport.listen_for_packet(): %s' % err)
+                rebuild = True
+                time.sleep(error_delay)
+                error_delay = min(error_delay * 2, ERROR_DELAY_MAX)
+                continue
+            except Exception:
                 self.logger.exception('Exception in transport.listen_for_packet():')
-                time.sleep(1)
+                rebuild = True
+                time.sleep(error_delay)
+                error_delay = min(error_delay * 2, ERROR_DELAY_MAX)
                 continue
-
-            if read_set or written_set:  # The MCCS has talked to us, update the last_readtime timestamp
-                self.readtime = time.time()
-
-            # If any registers have been written to, update the local instance attributes from the new values
-            if written_set:
-                self.handle_register_writes(slave_registers, written_set)
-
-            # Update the on/off state of all the ports, based on local instance attributes
-            goodcodes = [fndh.STATUS_OK, fndh.STATUS_WARNING]
-            if (self.statuscode not in goodcodes):  # If we're not OK or WARNING disable all the outputs
-                for port in self.ports.values():
-                    port.status_timestamp = time.time()
-                    port.current_timestamp = port.status_timestamp
-                    port.system_level_enabled = False
-                    port.system_online = self.online
-                    port.power_state = False
-                    port.power_sense = False
-            else:  # Otherwise, set the output state based on online/offline status and the four desired_state bits
+            error_delay = ERROR_DELAY_MIN
+
+            with self.state_lock:
+                now = time.time()
+                mono_now = time.monotonic()
+                if read_set or written_set:  # The MCCS has talked to us, update the last_readtime timestamp
+                    self.readtime = now
+                    self.heard_time = mono_now
+
+                # Go online as soon as the MCCS talks to us, and offline once we haven't heard from it for
+                # ONLINE_TIMEOUT seconds. We come back around this loop at least once a second, packet or not.
+                self.online = (self.heard_time is not None) and (mono_now - self.heard_time < ONLINE_TIMEOUT)
+
+                # If any registers have been written to, update the local instance attributes from the new values
+                if written_set:
+                    self.handle_register_writes(slave_registers, written_set)
+                    rebuild = True   # Overwrite any values written to read-only registers, and pick up new thresholds
+
+                # Update the on/off state of all the ports, based on local instance attributes. If we're not OK or WARNING
+                # disable all the outputs, otherwise set the output state based on online/offline status and the four
+                # desired_state bits
+                enabled = self.statuscode in GOOD_CODES
                 for port in self.ports.values():
-                    port.status_timestamp = time.time()
-                    port.current_timestamp = port.status_timestamp
-                    port.system_level_enabled = True
+                    port.status_timestamp = now
+                    port.current_timestamp = now
+                    port.system_level_enabled = enabled
                     port.system_online = self.online
-                    port_on = False
-                    if ( ( (self.online and port.desire_enabled_online)
-                           or ((not self.online) and port.desire_enabled_offline)
-                           or (port.locally_forced_on) )
-                         and (not port.locally_forced_off) ):
-                        port_on = True
-
+                    port_on = bool(enabled
+                                   and ((self.online and port.desire_enabled_online)
+                                        or ((not self.online) and port.desire_enabled_offline)
+                                        or port.locally_forced_on)
+                                   and (not port.locally_forced_off))
                     port.power_state = port_on
                     port.power_sense = port_on
 
@@ -287,46 +500,30 @@ class SimFNDH(fndh.FNDH):
         :return: None
         """
         # First handle the port state bitmap registers
-        for regnum in range(self.register_map['POLL']['P01_STATE'][0], self.register_map['POLL']['P28_STATE'][0] + 1):
-            if regnum in written_set:
-                port = self.ports[(regnum - self.register_map['POLL']['P01_STATE'][0]) + 1]
-                status_bitmap = slave_registers[regnum]
-                bitstring = "{:016b}".format(status_bitmap)
-
-                # Desired state online - R/W, write 00 if no change to current value
-                if (bitstring[2:4] == '10'):
-                    port.desire_enabled_online = False
-                elif (bitstring[2:4] == '11'):
-                    port.desire_enabled_online = True
-                elif (bitstring[2:4] == '00'):
-                    pass
-                else:
-                    self.logger.warning('Unknown desire enabled online flag: %s' % bitstring[2:4])
-                    port.desire_enabled_online = None
-
-                # Desired state offline - R/W, write 00 if no change to current value
-                if (bitstring[4:6] == '10'):
-                    port.desire_enabled_offline = False
-                elif (bitstring[4:6] == '11'):
-                    port.desire_enabled_offline = True
-                elif (bitstring[4:6] == '00'):
-                    pass
-                else:
-                    self.logger.warning('Unknown desired state offline flag: %s' % bitstring[4:6])
-                    port.desire_enabled_offline = None
-
-                # Technician override - R/W, write 00 if no change to current value
-                if (bitstring[6:8] == '10'):
-                    port.locally_forced_on = False
-                    port.locally_forced_off = True
-                elif (bitstring[6:8] == '11'):
-                    port.locally_forced_on = True
-                    port.locally_forced_off = False
-                elif (bitstring[6:8] == '01'):
-                    port.locally_forced_on = False
-                    port.locally_forced_off = False
-                else:
-                    pass
+        for regnum in (written_set & self.pstate_regnums):
+            port = self.ports[(regnum - self.pstate_base) + 1]
+            status_bitmap = slave_registers[regnum]
+
+            # Desired state online - R/W, write 00 if no change to current value
+            flag = (status_bitmap >> 12) & 0b11
+            if flag in DESIRE_FLAGS:
+                port.desire_enabled_online = DESIRE_FLAGS[flag]
+            elif flag:
+                self.logger.warning('Unknown desire enabled online flag: {:02b}'.format(flag))
+                port.desire_enabled_online = None
+
+            # Desired state offline - R/W, write 00 if no change to current value
+            flag = (status_bitmap >> 10) & 0b11
+            if flag in DESIRE_FLAGS:
+                port.desire_enabled_offline = DESIRE_FLAGS[flag]
+            elif flag:
+                self.logger.warning('Unknown desired state offline flag: {:02b}'.format(flag))
+                port.desire_enabled_offline = None
+
+            # Technician override - R/W, write 00 if no change to current value
+            flag = (status_bitmap >> 8) & 0b11
+            if flag in OVERRIDE_FLAGS:
+                port.locally_forced_on, port.locally_forced_off = OVERRIDE_FLAGS[flag]
 
         # Now update ay new threshold data from the configuration registers.
         for regname in self.register_map['CONF']:
@@ -339,14 +536,27 @@ class SimFNDH(fndh.FNDH):
 
         # Now update the service LED state (data in the LSB is ignored, because the microcontroller handles the
         # status LED).
-        if self.register_map['POLL']['SYS_LIGHTS'][0] in written_set:  # Wrote to SYS_LIGHTS, so set light attributes
-            msb, lsb = divmod(slave_registers[self.register_map['POLL']['SYS_LIGHTS'][0]], 256)
-            self.service_led = bool(msb)
+        if self.lights_regnum in written_set:  # Wrote to SYS_LIGHTS, so set light attributes
+            self.service_led = (slave_registers[self.lights_regnum] >> 8) != 0   # Only the MSB (service LED) is writeable
 
-        if self.register_map['POLL']['SYS_STATUS'][0] in written_set:  # Wrote to SYS_STATUS, so clear UNINITIALISED state
+        if self.status_regnum in written_set:  # Wrote to SYS_STATUS, so clear UNINITIALISED state
             self.initialised = True
             self.longpress = False    # Clear the 'long button press' flag, because the restart process is happening
 
+    def set_sensor_state(self, regname, newstate):
+        """
+        Change the state of a single sensor, keeping the count of sensors in each state up to date.
+
+        :param regname: CONF register name for the sensor, eg 'SYS_48V1_V_TH'
+        :param newstate: New state for that sensor, eg 'OK', 'WARNING', 'ALARM' or 'RECOVERY'
+        :return: None
+        """
+        oldstate = self.sensor_states[regname]
+        if oldstate != newstate:
+            self.state_counts[oldstate] -= 1
+            self.state_counts[newstate] += 1
+            self.sensor_states[regname] = newstate
+
     def sim_loop(self):
         """
         Runs continuously, simulating hardware processes independent of the communications packet handler
@@ -356,7 +566,7 @@ class SimFNDH(fndh.FNDH):
 
         :return: None
         """
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
 
         self.statuscode = fndh.STATUS_UNINITIALISED
         self.status = 'UNINITIALISED'
@@ -364,160 +574,108 @@ class SimFNDH(fndh.FNDH):
         self.indicator_state = 'YELLOWFAST'
 
         self.logger.info('Started comms thread for FNDH')
-        listen_thread = threading.Thread(target=self.listen_loop, daemon=False, name=threading.current_thread().name + '-C')
+        listen_thread = threading.Thread(target=self.listen_loop, daemon=True, name=threading.current_thread().name + '-C')
         listen_thread.start()
 
         self.logger.info('Started simulation loop for FNDH')
+        next_tick = time.monotonic()
         while not self.wants_exit:  # Process packets until we are told to die
-            self.uptime = int(time.time() - self.start_time)  # Set the current uptime value
-
-            # Update the online/offline state, depending on how long it's been since the MCCS last sent a packet to us
-            # Note that the port powerup/powerdown as a result of online/offline transitions is handled in the listen_loop
-            if (time.time() - self.readtime >= 300) and self.online:  # More than 5 minutes since we heard from MCCS, go offline
-                self.online = False
-                for port in self.ports.values():
-                    port.system_online = False
-            elif (time.time() - self.readtime < 300) and (not self.online):  # Less than 5 minutes since we heard from MCCS, go online
-                self.online = True
-                for port in self.ports.values():
-                    port.system_online = True
-
-            time.sleep(0.5)
-
-            # Change the sensor values to generate a random walk around a mean value for each sensor
-            self.psu48v1_voltage = random_walk(self.psu48v1_voltage, mean=48.1, scale=0.25)
-            self.psu48v2_voltage = random_walk(self.psu48v2_voltage, mean=48.1, scale=0.25)
-            self.psu48v_current = random_walk(self.psu48v_current, mean=13.4, scale=0.25)
-            self.psu48v1_temp = random_walk(self.psu48v1_temp, mean=58.3, scale=0.25)
-            self.psu48v2_temp = random_walk(self.psu48v2_temp, mean=5.1, scale=0.25)
-            self.panel_temp = random_walk(self.panel_temp, mean=55.1, scale=0.25)
-            self.fncb_temp = random_walk(self.fncb_temp, mean=48.1, scale=0.25)
-            self.fncb_humidity = random_walk(self.fncb_humidity, mean=38.1, scale=0.25)
-
-            if self.initialised:     # Don't bother thresholding sensor values until the thresholds have been set
-                # For each threshold register, get the current value and threshold/s from the right local instance attribute
-                for regname in self.register_map['CONF']:
-                    ah, wh, wl, al = self.thresholds[regname]
-                    curstate = self.sensor_states[regname]
-                    if regname == 'SYS_48V1_V_TH':
-                        curvalue = self.psu48v1_voltage
-                    elif regname == 'SYS_48V2_V_TH':
-                        curvalue = self.psu48v2_voltage
-                    elif regname == 'SYS_48V_I_TH':
-                        curvalue = self.psu48v_current
-                    elif regname == 'SYS_48V1_TEMP_TH':
-                        curvalue = self.psu48v1_temp
-                    elif regname == 'SYS_48V2_TEMP_TH':
-                        curvalue = self.psu48v2_temp
-                    elif regname == 'PANEL_TEMP_TH':
-                        curvalue = self.panel_temp
-                    elif regname == 'SYS_FNCBTEMP_TH':
-                        curvalue = self.fncb_temp
-                    elif regname == 'SYS_HUMIDITY_TH':
-                        curvalue = self.fncb_humidity
-                    elif regname.startswith('SYS_SENSE'):
-                        curvalue = self.sensor_temps[int(regname[9:11])]
-                    else:
-                        self.logger.critical('Configuration register %s not handled by simulation code')
-                        return
-
-                    # Now use the current value and threshold/s to find the new state for that sensor
-                    newstate = curstate
-                    if curvalue > ah:
-                        newstate = 'ALARM'
-                    elif wh < curvalue <= ah:
-                        if curstate == 'ALARM':
-                            newstate = 'RECOVERY'
-                        elif curstate != 'RECOVERY':
-                            newstate = 'WARNING'
-                    elif wl <= curvalue <= wh:
-                        newstate = 'OK'
-                    elif al <= curvalue < wl:
-                        if curstate == 'ALARM':
-                            newstate = 'RECOVERY'
-                        elif curstate != 'RECOVERY':
-                            newstate = 'WARNING'
-                    elif curvalue < al:
-                        newstate = 'ALARM'
-
-                    # Log any change in state
-                    if curstate != newstate:
-                        msg = 'Sensor %s transitioned from %s to %s with reading of %4.2f and thresholds of %3.1f, %3.1f, %3.1f, %3.1f'
-                        self.logger.warning(msg % (regname[:-3],
-                                                   curstate,
-                                                   newstate,
-                                                   curvalue,
-                                                   ah,wh,wl,al))
-
-                    # Record the new state for that sensor in a dictionary with all sensor states
-                    self.sensor_states[regname] = newstate
-
-            if self.shortpress:   # Unhandled short button press - reset any faults and technician overrides, try again
-                # Change any 'RECOVERY' sensor states to WARNING
-                for regname, value in self.sensor_states.items():
-                    if value == 'RECOVERY':
-                        self.sensor_states[regname] = 'WARNING'
-
-                # Clear any port locally_forced_* bits
-                # And reset any tripped software breakers
-                for p in self.ports.values():
-                    p.locally_forced_on = False
-                    p.locally_forced_off = False
-                    p.breaker_tripped = False
-
-                self.shortpress = False   # Handled, so clear the flag
-
-            if self.mediumpress:
-                # Force all the FEM ports off
-                for p in self.ports.values():
-                    p.locally_forced_on = False
-                    p.locally_forced_off = True
-                self.mediumpress = False
-
-            if self.longpress:
-                # Ask for a restart (all ports off, then on again every 10 seconds to map smartboxes to PDoC ports)
-                # Force all the FEM ports off  - TODO - this must only be one port to be compliant, so we need to maintain
-                # our mapping of modbus address to PDoC port over individual port outages
-                for p in self.ports.values():
-                    p.locally_forced_on = False
-                    p.locally_forced_off = True
-                self.statuscode = fndh.STATUS_POWERUP
-                self.indicator_code = fndh.LED_GREENRED
-                self.indicator_state = 'GREENRED'
-                continue
-
-            # Now update the overall box state, based on all of the sensor states
-            if self.initialised:
-                if 'ALARM' in self.sensor_states.values():  # If any sensor is in ALARM, so is thw whole box
-                    self.statuscode = fndh.STATUS_ALARM
-                    if self.online:
-                        self.indicator_code = fndh.LED_REDSLOW
-                    else:
-                        self.indicator_code = fndh.LED_RED
-                elif 'RECOVERY' in self.sensor_states.values():  # Otherwise, if any sensor is RECOVERY, so is the whole box
-                    self.statuscode = fndh.STATUS_RECOVERY
-                    if self.online:
-                        self.indicator_code = fndh.LED_YELLOWREDSLOW
-                    else:
-                        self.indicator_code = fndh.LED_YELLOWRED
-                elif 'WARNING' in self.sensor_states.values():  # Otherwise, if any sensor is WARNING, so is the whole box
-                    self.statuscode = fndh.STATUS_WARNING
-                    if self.online:
-                        self.indicator_code = fndh.LED_YELLOWSLOW
-                    else:
-                        self.indicator_code = fndh.LED_YELLOW
-                else:
-                    self.statuscode = fndh.STATUS_OK  # If all sensors are OK, so is the whole box
-                    if self.online:
-                        self.indicator_code = fndh.LED_GREENSLOW
-                    else:
-                        self.indicator_code = fndh.LED_GREEN
+            now = time.monotonic()
+            with self.state_lock:
+                self.uptime = int(now - self.start_time)  # Set the current uptime value
+
+            # Sleep until the next tick is due, so the time spent simulating doesn't add up to a drift in the tick
+            # rate. If we've fallen behind, start again from now instead of trying to catch up. A button press
+            # ends the sleep early.
+            next_tick += SIM_TICK
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                if self.button_event.wait(delay):
+                    self.button_event.clear()
             else:
-                self.statuscode = fndh.STATUS_UNINITIALISED
-                self.indicator_code = fndh.LED_YELLOWFAST  # Fast flash green - uninitialised
+                next_tick = time.monotonic()
+
+            with self.state_lock:
+                # Change the sensor values to generate a random walk around a mean value for each sensor
+                rand = self.rng.random
+                for attr, mean in SENSOR_MEANS:
+                    setattr(self, attr, random_walk(getattr(self, attr), mean=mean, scale=0.25, rand=rand))
+
+                if self.initialised:     # Don't bother thresholding sensor values until the thresholds have been set
+                    # For each threshold register, get the current value and threshold/s from the right local instance attribute
+                    for regname in self.register_map['CONF']:
+                        ah, wh, wl, al = self.thresholds[regname]
+                        curstate = self.sensor_states[regname]
+                        getter = self.threshold_getters.get(regname)
+                        if getter is None:
+                            self.logger.critical('Configuration register %s not handled by simulation code' % regname)
+                            return
+                        curvalue = getter(self)
+
+                        # Now use the current value and threshold/s to find the new state for that sensor
+                        newstate = threshold_state(curvalue, ah, wh, wl, al, curstate)
+
+                        # Log any change in state
+                        if curstate != newstate:
+                            msg = 'Sensor %s transitioned from %s to %s with reading of %4.2f and thresholds of %3.1f, %3.1f, %3.1f, %3.1f'
+                            self.logger.warning(msg,
+                                                regname[:-3],
+                                                curstate,
+                                                newstate,
+                                                curvalue,
+                                                ah, wh, wl, al)
+
+                        # Record the new state for that sensor in a dictionary with all sensor states
+                        self.set_sensor_state(regname, newstate)
+
+                if self.shortpress:   # Unhandled short button press - reset any faults and technician overrides, try again
+                    # Change any 'RECOVERY' sensor states to WARNING
+                    if self.state_counts['RECOVERY']:
+                        for regname, value in list(self.sensor_states.items()):
+                            if value == 'RECOVERY':
+                                self.set_sensor_state(regname, 'WARNING')
+
+                    # Clear any port locally_forced_* bits
+                    # And reset any tripped software breakers
+                    for p in self.ports.values():
+                        p.locally_forced_on = False
+                        p.locally_forced_off = False
+                        p.breaker_tripped = False
+
+                    self.shortpress = False   # Handled, so clear the flag
+
+                if self.mediumpress:
+                    # Force all the FEM ports off
+                    for p in self.ports.values():
+                        p.locally_forced_on = False
+                        p.locally_forced_off = True
+                    self.mediumpress = False
+
+                if self.longpress:
+                    # Ask for a restart (all ports off, then on again every 10 seconds to map smartboxes to PDoC ports)
+                    # Force all the FEM ports off  - TODO - this must only be one port to be compliant, so we need to maintain
+                    # our mapping of modbus address to PDoC port over individual port outages
+                    for p in self.ports.values():
+                        p.locally_forced_on = False
+                        p.locally_forced_off = True
+                    self.statuscode = fndh.STATUS_POWERUP
+                    self.indicator_code = fndh.LED_GREENRED
+                    self.indicator_state = 'GREENRED'
+                    continue
+
+                # Now update the overall box state, based on all of the sensor states - the box takes the status of the
+                # most severe state of any of its sensors
+                if self.initialised:
+                    statuscode, offline_led, online_led = next((codes for state, codes in BOX_STATES if self.state_counts[state]),
+                                                               BOX_OK)
+                    self.statuscode = statuscode
+                    self.indicator_code = online_led if self.online else offline_led
+                else:
+                    self.statuscode = fndh.STATUS_UNINITIALISED
+                    self.indicator_code = fndh.LED_YELLOWFAST  # Fast flash green - uninitialised
 
-            self.status = fndh.STATUS_CODES[self.statuscode]
-            self.indicator_state = fndh.LED_CODES[self.indicator_code]
+                self.status = fndh.STATUS_CODES[self.statuscode]
+                self.indicator_state = fndh.LED_CODES[self.indicator_code]
 
         self.logger.info('Ending sim_loop() in SimFNDH')
 
@@ -42,6 +42,8 @@ DEFAULT_STATION_NUMBER = 1
 
 CARBON_HOST = ''   # Overwritten by value from config file on startup
 
+FRESH_CHANNEL = 'pasd_fresh'   # Channel to NOTIFY (with a unix timestamp) after each database update, for scmd.py
+
 FNDH_STATE_QUERY = """
 UPDATE pasd_fndh_state
     SET mbrv = %(mbrv)s, pcbrv = %(pcbrv)s, cpuid = %(cpuid)s, chipid = %(chipid)s, 
@@ -140,35 +142,46 @@ def initialise_db(db, stn):
                 curs.execute('DELETE FROM pasd_fndh_state WHERE (station_id = %s)', (stn.station_id,))
                 curs.execute('INSERT INTO pasd_fndh_state (station_id) VALUES (%s)', (stn.station_id,))
 
-            for pnum in range(1, 29):
-                curs.execute('SELECT COUNT(*) FROM pasd_fndh_port_status WHERE (station_id = %s) AND (pdoc_number = %s)',
-                             (stn.station_id, pnum))
-                if curs.fetchone()[0] != 1:   # No rows match, or more than one row matches:
-                    logging.info('Creating FNDH port state for station %d, port %d' % (stn.station_id, pnum))
-                    curs.execute('DELETE FROM pasd_fndh_port_status WHERE (station_id = %s) AND (pdoc_number = %s)',
-                                 (stn.station_id, pnum))
-                    curs.execute('INSERT INTO pasd_fndh_port_status (station_id, pdoc_number, desire_enabled_offline, desire_enabled_online) VALUES (%s, %s, %s, %s)',
-                                 (stn.station_id, pnum, True, True))
-
-            for sb_num in range(1, 25):
-                curs.execute('SELECT COUNT(*) FROM pasd_smartbox_state WHERE (station_id = %s) AND (smartbox_number = %s)',
-                             (stn.station_id, sb_num))
-                if curs.fetchone()[0] != 1:   # No rows match, or more than one row matches:
-                    logging.info('Creating Smartbox state for station %d, SB %d' % (stn.station_id, sb_num))
-                    curs.execute('DELETE FROM pasd_smartbox_state WHERE (station_id = %s) AND (smartbox_number = %s)',
-                                 (stn.station_id, sb_num))
-                    curs.execute('INSERT INTO pasd_smartbox_state (station_id, smartbox_number) VALUES (%s, %s)',
-                                 (stn.station_id, sb_num))
-
-                for pnum in range(1, 13):
-                    curs.execute('SELECT COUNT(*) FROM pasd_smartbox_port_status WHERE (station_id = %s) AND (smartbox_number = %s) AND (port_number = %s)',
-                                 (stn.station_id, sb_num, pnum))
-                    if curs.fetchone()[0] != 1:   # No rows match, or more than one row matches:
-                        logging.info('Creating Smartbox port state for station %d, SB %d, port %d' % (stn.station_id, sb_num, pnum))
-                        curs.execute('DELETE FROM pasd_smartbox_port_status WHERE (station_id = %s) AND (smartbox_number = %s) AND (port_number = %s)',
-                                     (stn.station_id, sb_num, pnum))
-                        curs.execute('INSERT INTO pasd_smartbox_port_status (station_id, smartbox_number, port_number, desire_enabled_offline, desire_enabled_online) VALUES (%s, %s, %s, %s, %s)',
-                                     (stn.station_id, sb_num, pnum, True, True))
+            # For the port and smartbox tables, find all the rows that already exist exactly once with a single query
+            # per table, then delete/recreate any missing or duplicated rows with batched statements.
+            curs.execute('SELECT pdoc_number FROM pasd_fndh_port_status WHERE (station_id = %s) GROUP BY pdoc_number HAVING COUNT(*) = 1',
+                         (stn.station_id,))
+            goodrows = {row[0] for row in curs}
+            badrows = [pnum for pnum in range(1, 29) if pnum not in goodrows]
+            for pnum in badrows:
+                logging.info('Creating FNDH port state for station %d, port %d' % (stn.station_id, pnum))
+            psycopg2.extras.execute_batch(curs,
+                                          'DELETE FROM pasd_fndh_port_status WHERE (station_id = %s) AND (pdoc_number = %s)',
+                                          [(stn.station_id, pnum) for pnum in badrows])
+            psycopg2.extras.execute_batch(curs,
+                                          'INSERT INTO pasd_fndh_port_status (station_id, pdoc_number, desire_enabled_offline, desire_enabled_online) VALUES (%s, %s, %s, %s)',
+                                          [(stn.station_id, pnum, True, True) for pnum in badrows])
+
+            curs.execute('SELECT smartbox_number FROM pasd_smartbox_state WHERE (station_id = %s) GROUP BY smartbox_number HAVING COUNT(*) = 1',
+                         (stn.station_id,))
+            goodrows = {row[0] for row in curs}
+            badrows = [sb_num for sb_num in range(1, 25) if sb_num not in goodrows]
+            for sb_num in badrows:
+                logging.info('Creating Smartbox state for station %d, SB %d' % (stn.station_id, sb_num))
+            psycopg2.extras.execute_batch(curs,
+                                          'DELETE FROM pasd_smartbox_state WHERE (station_id = %s) AND (smartbox_number = %s)',
+                                          [(stn.station_id, sb_num) for sb_num in badrows])
+            psycopg2.extras.execute_batch(curs,
+                                          'INSERT INTO pasd_smartbox_state (station_id, smartbox_number) VALUES (%s, %s)',
+                                          [(stn.station_id, sb_num) for sb_num in badrows])
+
+            curs.execute('SELECT smartbox_number, port_number FROM pasd_smartbox_port_status WHERE (station_id = %s) GROUP BY smartbox_number, port_number HAVING COUNT(*) = 1',
+                         (stn.station_id,))
+            goodrows = {(row[0], row[1]) for row in curs}
+            badrows = [(sb_num, pnum) for sb_num in range(1, 25) for pnum in range(1, 13) if (sb_num, pnum) not in goodrows]
+            for sb_num, pnum in badrows:
+                logging.info('Creating Smartbox port state for station %d, SB %d, port %d' % (stn.station_id, sb_num, pnum))
+            psycopg2.extras.execute_batch(curs,
+                                          'DELETE FROM pasd_smartbox_port_status WHERE (station_id = %s) AND (smartbox_number = %s) AND (port_number = %s)',
+                                          [(stn.station_id, sb_num, pnum) for sb_num, pnum in badrows])
+            psycopg2.extras.execute_batch(curs,
+                                          'INSERT INTO pasd_smartbox_port_status (station_id, smartbox_number, port_number, desire_enabled_offline, desire_enabled_online) VALUES (%s, %s, %s, %s, %s)',
+                                          [(stn.station_id, sb_num, pnum, True, True) for sb_num, pnum in badrows])
 
 
 def update_db(db, stn):
@@ -235,6 +248,12 @@ def update_db(db, stn):
             psycopg2.extras.execute_batch(curs, SMARTBOX_STATE_QUERY, sb_data_list)
             psycopg2.extras.execute_batch(curs, SMARTBOX_PORT_QUERY, sb_ports_data_list)
 
+    # Tell any listening clients that fresh data is available. This is only sent after the updates above have been
+    # committed, so a client that sees the notification will always see the new data.
+    with db:  # Commit transaction (and send the notification) when block exits
+        with db.cursor() as curs:
+            curs.execute('SELECT pg_notify(%s, %s)', (FRESH_CHANNEL, '%14.3f' % time.time()))
+
 
 def get_antenna_map(db, station_number=DEFAULT_STATION_NUMBER):
     """
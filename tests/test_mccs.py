@@ -0,0 +1,91 @@
+"""
+Tests for sid.mccs.MCCS, using a fake connection object instead of a real Modbus link.
+"""
+
+import unittest
+
+from sid import mccs
+
+
+class FakeConn(object):
+    """
+    Stands in for transport.Connection - every register read returns the bytes (1, 2) for each register, which
+    is the register value 1 * 256 + 2 = 258.
+    """
+    def readReg(self, modbus_address, regnum, numreg=1, raw=False):
+        return bytes([1, 2] * numreg)
+
+
+class LogConn(FakeConn):
+    """
+    Records every writeMultReg() call as (regnum, valuelist). If fail_message is 'fail', writes to the log message
+    registers return False, and if it's 'raise', they raise IOError.
+    """
+    def __init__(self, fail_message=None):
+        self.fail_message = fail_message
+        self.writes = []
+
+    def writeMultReg(self, modbus_address, regnum, valuelist):
+        self.writes.append((regnum, valuelist))
+        if regnum == mccs.MESSAGE:
+            if self.fail_message == 'fail':
+                return False
+            elif self.fail_message == 'raise':
+                raise IOError
+        return True
+
+
+class TestReadAntennae(unittest.TestCase):
+    def test_pdoc_registers_use_both_bytes(self):
+        # The pdoc decode used to add the MSB to itself, instead of using the LSB, giving 257 here instead of 258
+        m = mccs.MCCS(conn=FakeConn())
+        self.assertTrue(m.read_antennae())
+        self.assertEqual(m.pdocs[0], 258)   # PDoC port 1
+        self.assertEqual(list(m.pdocs), [258] * 28)
+
+    def test_antenna_registers(self):
+        m = mccs.MCCS(conn=FakeConn())
+        self.assertTrue(m.read_antennae())
+        self.assertEqual(list(m.antennae), [258] * 256)
+        self.assertEqual(m.get_antenna(1), (1, 2))
+
+
+class TestMapAntenna(unittest.TestCase):
+    def remap(self, old_antnum, new_antnum):
+        # Move SMARTbox 1 port 2 from old_antnum to new_antnum, and return the registers written
+        conn = LogConn()
+        m = mccs.MCCS(conn=conn)
+        m.antennae[old_antnum - 1] = 258
+        m.antenna_index[258] = old_antnum
+        self.assertTrue(m.map_antenna(new_antnum, 1, 2))
+        return conn.writes
+
+    def test_adjacent_registers_written_together(self):
+        self.assertEqual(self.remap(5, 6), [(5, [0, 258])])
+
+    def test_registers_in_between_not_written(self):
+        self.assertEqual(self.remap(5, 10), [(5, [0]), (10, [258])])
+
+
+class TestLogCursor(unittest.TestCase):
+    def test_cursor_reused_after_good_write(self):
+        conn = LogConn()
+        m = mccs.MCCS(conn=conn)
+        self.assertTrue(m.write_log_message(desired_antenna=5, log_message='Replaced LNA'))
+        conn.writes = []
+        self.assertIsNotNone(m.get_log_message(desired_antenna=5))
+        self.assertEqual(conn.writes, [])   # The MCCS already has this antenna/chipid/lognum
+
+    def test_cursor_cleared_after_failed_message_write(self):
+        for fail_message in ['fail', 'raise']:
+            conn = LogConn(fail_message=fail_message)
+            m = mccs.MCCS(conn=conn)
+            self.assertFalse(m.write_log_message(desired_antenna=5, log_message='Replaced LNA'), fail_message)
+            self.assertIsNone(m.log_cursor, fail_message)
+            conn.writes = []
+            m.get_log_message(desired_antenna=5)
+            self.assertEqual([regnum for regnum, valuelist in conn.writes], [mccs.ANTNUM], fail_message)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Tests for the scmd.py command line tool, with the database calls replaced by mock objects.
+"""
+
+import contextlib
+import shlex
+import unittest
+from unittest import mock
+
+import scmd
+
+
+@contextlib.contextmanager
+def fake_cursor():
+    yield mock.Mock()
+
+
+class TestSmartboxNumbers(unittest.TestCase):
+    def setUp(self):
+        self.execute_values = mock.Mock()
+        patches = [mock.patch.object(scmd, 'db_cursor', fake_cursor),
+                   mock.patch.object(scmd, 'shadow_clear', mock.Mock()),
+                   mock.patch.object(scmd.psycopg2.extras, 'execute_values', self.execute_values)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_sbports_documented_examples(self):
+        # Run every example in the 'scmd sbports' help text, so the examples can't drift out of range
+        examples = [line.split('#')[0] for line in scmd.sbports.callback.__doc__.splitlines()
+                    if line.strip().startswith('$ scmd sbports')]
+        self.assertTrue(examples)
+        for example in examples:
+            action, *portspecs = shlex.split(example)[3:]
+            self.execute_values.reset_mock()
+            self.assertIsNone(scmd.sbports.callback(portspecs=tuple(portspecs), action=action), example)
+            self.assertTrue(self.execute_values.call_args.args[2], example)
+
+        # Last example turns off all ports except 12 on smartbox 1, and all ports on smartbox 2
+        valuelist = self.execute_values.call_args.args[2]
+        self.assertEqual([(sbnum, pnum) for _, sbnum, pnum, _ in valuelist],
+                         [(1, p) for p in range(1, 12)] + [(2, p) for p in range(1, 13)])
+        self.assertFalse(any(state for _, _, _, state in valuelist))
+
+    def test_sbports_rejects_bad_specs(self):
+        for portspecs in [('0:1',), ('%d:1' % (scmd.MAX_SMARTBOX + 1),), ('1',), ('1:',), ('1:1', '1:2')]:
+            self.assertEqual(scmd.sbports.callback(portspecs=portspecs, action='on'), -1, portspecs)
+        self.execute_values.assert_not_called()
+
+    def test_sb_and_sbports_agree(self):
+        for sbnum in ['0', '1', str(scmd.MAX_SMARTBOX), str(scmd.MAX_SMARTBOX + 1), 'x']:
+            sb_ok = scmd.sb.callback(portnums=('1',), action='on', sbnum=sbnum, cached=False) is None
+            sbports_ok = scmd.sbports.callback(portspecs=(sbnum + ':1',), action='on') is None
+            self.assertEqual(sb_ok, sbports_ok, sbnum)
+            self.assertEqual(sb_ok, scmd.parse_sbnum(sbnum) is not None, sbnum)
+
+
+if __name__ == '__main__':
+    unittest.main()